@@ -0,0 +1,282 @@
+import threading
+import uuid
+import json
+import time
+
+import numpy as np
+
+from typing import Optional
+
+
+class AnswerCache:
+    """Answers to questions already asked about a book.
+
+    A new question is answered from the cache if its embedding is close
+    enough to that of a previously answered question. Entries are kept
+    in the book keeper's database, the question embeddings of each book
+    are also held in memory as one matrix. Entries are only matched
+    against questions embedded by the same embedder. Entries expire
+    after ttl seconds, and only the newest max_entries are kept per
+    book."""
+
+    def __init__(self, keeper, threshold, ttl, max_entries):
+        """Create an answer cache stored by the book keeper."""
+        self.keeper = keeper
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (book id, embedder) -> {"entry_ids", "created_at", "embeddings"}
+        self.books = {}
+        self.hits = {}
+        self.misses = {}
+
+    def create_schema(self, conn):
+        """Create the database schema if it does not exist."""
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                entry_id TEXT PRIMARY KEY,
+                book_id TEXT NOT NULL,
+                embedder TEXT NOT NULL DEFAULT '',
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                quote TEXT,
+                rel_doc_ids TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """
+        )
+        columns = [
+            row[1]
+            for row in conn.execute("PRAGMA table_info(answer_cache)")
+        ]
+        if "embedder" not in columns:
+            # entries of older versions match no embedder
+            conn.execute(
+                """
+                ALTER TABLE answer_cache
+                ADD COLUMN embedder TEXT NOT NULL DEFAULT ''
+                """
+            )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS answer_cache_book
+            ON answer_cache (book_id, created_at);
+            """
+        )
+
+    def lookup(self, book_id, embedder, embedding) -> Optional[dict]:
+        """Find the answer to a question similar to the given one,
+        embedded by the embedder of the given name."""
+        query = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            book = self._book(book_id, embedder)
+            now = time.time()
+            fresh = book["created_at"] > now - self.ttl
+
+            entry_id = None
+            if fresh.any() and _dim(book) == len(query):
+                scores = book["embeddings"] @ query
+                scores[~fresh] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry_id = book["entry_ids"][best]
+
+            counter = self.misses if entry_id is None else self.hits
+            counter[book_id] = counter.get(book_id, 0) + 1
+
+        if entry_id is None:
+            return None
+
+        cursor = self.keeper.conn.execute(
+            """
+            SELECT question, answer, quote, rel_doc_ids
+            FROM answer_cache
+            WHERE entry_id = ?
+            """,
+            (entry_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        question, answer, quote, rel_doc_ids = row
+        return {
+            "question": question,
+            "answer": answer,
+            "quote": quote,
+            "rel_doc_ids": json.loads(rel_doc_ids),
+        }
+
+    def add(
+        self,
+        book_id,
+        embedder,
+        question,
+        embedding,
+        answer,
+        quote,
+        rel_doc_ids,
+    ):
+        """Remember the answer to a question embedded by the embedder of
+        the given name.
+
+        rel_doc_ids lists the ids of the documents merged into each
+        relevant document. Answers cached under other embedders of the
+        book are dropped, they can no longer be matched."""
+        entry_id = str(uuid.uuid4())
+        embedding = np.asarray(embedding, dtype=np.float32)
+        created_at = time.time()
+
+        conn = self.keeper.conn
+        conn.execute(
+            """
+            INSERT INTO answer_cache (entry_id, book_id, embedder,
+                question, embedding, answer, quote, rel_doc_ids,
+                created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                entry_id,
+                book_id,
+                embedder,
+                question,
+                embedding.tobytes(),
+                answer,
+                quote,
+                json.dumps(rel_doc_ids),
+                created_at,
+            ),
+        )
+        conn.execute(
+            """
+            DELETE FROM answer_cache
+            WHERE book_id = ? AND (
+                embedder != ? OR created_at < ? OR entry_id NOT IN (
+                    SELECT entry_id FROM answer_cache
+                    WHERE book_id = ?
+                    ORDER BY created_at DESC
+                    LIMIT ?
+                )
+            )
+            """,
+            (
+                book_id,
+                embedder,
+                created_at - self.ttl,
+                book_id,
+                self.max_entries,
+            ),
+        )
+        conn.commit()
+
+        with self.lock:
+            for key in [key for key in self.books if key[0] == book_id]:
+                if key[1] != embedder:
+                    del self.books[key]
+
+            book = self._book(book_id, embedder)
+            entry_ids = book["entry_ids"] + [entry_id]
+            created = np.append(book["created_at"], created_at)
+            embeddings = embedding[None]
+            if book["entry_ids"] and _dim(book) == len(embedding):
+                embeddings = np.vstack([book["embeddings"], embeddings])
+            else:
+                # nothing cached yet, or embedded in another space
+                entry_ids = [entry_id]
+                created = created[-1:]
+
+            # entries are ordered by age, evict from the front
+            keep = created >= created_at - self.ttl
+            keep[: max(len(entry_ids) - self.max_entries, 0)] = False
+            self.books[(book_id, embedder)] = {
+                "entry_ids": [e for e, k in zip(entry_ids, keep) if k],
+                "created_at": created[keep],
+                "embeddings": embeddings[keep],
+            }
+
+    def _book(self, book_id, embedder):
+        """Get the in-memory index of the entries of a book embedded by
+        an embedder, loading it if needed."""
+        key = (book_id, embedder)
+        if key in self.books:
+            return self.books[key]
+
+        cursor = self.keeper.conn.execute(
+            """
+            SELECT entry_id, embedding, created_at
+            FROM answer_cache
+            WHERE book_id = ? AND embedder = ? AND created_at >= ?
+            ORDER BY created_at
+            """,
+            (book_id, embedder, time.time() - self.ttl),
+        )
+        rows = cursor.fetchall()
+        # the same name may have embedded in another dimension before
+        if rows:
+            dim = len(rows[-1][1])
+            rows = [row for row in rows if len(row[1]) == dim]
+
+        embeddings = [
+            np.frombuffer(blob, dtype=np.float32) for _, blob, _ in rows
+        ]
+        self.books[key] = {
+            "entry_ids": [entry_id for entry_id, _, _ in rows],
+            "created_at": np.array(
+                [created_at for _, _, created_at in rows], dtype=np.float64
+            ),
+            "embeddings": np.vstack(embeddings)
+            if embeddings
+            else np.zeros((0, 0), dtype=np.float32),
+        }
+        return self.books[key]
+
+    def clear(self, book_id):
+        """Forget all answers about a book, e.g. after re-indexing it."""
+        self.keeper.conn.execute(
+            """
+            DELETE FROM answer_cache
+            WHERE book_id = ?
+            """,
+            (book_id,),
+        )
+        self.keeper.conn.commit()
+
+        with self.lock:
+            for key in [key for key in self.books if key[0] == book_id]:
+                del self.books[key]
+            self.hits.pop(book_id, None)
+            self.misses.pop(book_id, None)
+
+    def stats(self, book_id=None):
+        """Get the hit/miss counters of a book, or of all books."""
+        with self.lock:
+            if book_id is None:
+                hits = sum(self.hits.values())
+                misses = sum(self.misses.values())
+                size = sum(
+                    len(b["entry_ids"]) for b in self.books.values()
+                )
+            else:
+                hits = self.hits.get(book_id, 0)
+                misses = self.misses.get(book_id, 0)
+                size = sum(
+                    len(b["entry_ids"])
+                    for key, b in self.books.items()
+                    if key[0] == book_id
+                )
+
+        total = hits + misses
+        return {
+            "size": size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+def _dim(book):
+    """Get the dimension of the cached embeddings of a book."""
+    return book["embeddings"].shape[1]
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Optional, List, NewType, Any
+from typing import Optional, List, NewType, Any, Tuple, Dict, Iterator
 
 from pydantic import BaseModel
 import numpy as np
@@ -50,6 +50,60 @@ class Document(BaseModel):
         )
 
 
+class DocumentBatch:
+    """Candidate documents as arrays rather than Document objects.
+
+    Each row is a run of linked documents, the positions start to end
+    (inclusive) of a DocumentChains, with the embedding of the run in a
+    single float32 matrix. Content is only joined when asked for."""
+
+    def __init__(
+        self,
+        chains: Any,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        embeddings: np.ndarray,
+    ):
+        """Create a batch of runs over the chained documents."""
+        self.chains = chains
+        self.starts = starts
+        self.ends = ends
+        self.embeddings = embeddings
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def take(self, indices: Any) -> "DocumentBatch":
+        """Select rows of the batch, in the given order."""
+        indices = np.asarray(indices, dtype=np.intp)
+        return DocumentBatch(
+            self.chains,
+            self.starts[indices],
+            self.ends[indices],
+            self.embeddings[indices],
+        )
+
+    def merged_ids(self, i: int) -> List[DocId]:
+        """Get the ids of the documents in a row."""
+        return self.chains.ids[self.starts[i] : self.ends[i] + 1]
+
+    def spans(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the span keys of the rows, -1 where unknown."""
+        chains = self.chains
+        span_starts = chains.span_start[self.starts]
+        span_ends = chains.span_end[self.ends]
+        unknown = (span_starts < 0) | (span_ends < 0)
+        span_starts[unknown] = -1
+        span_ends[unknown] = -1
+        return span_starts, span_ends
+
+    def content(self, i: int) -> str:
+        """Get the content of a row."""
+        return "".join(
+            self.chains.contents[self.starts[i] : self.ends[i] + 1]
+        )
+
+
 class DocStore(ABC):
     @abstractmethod
     def put(self, docs: List[Document]) -> None:
@@ -63,6 +117,13 @@ class DocStore(ABC):
     def dump(self) -> List[Document]:
         """Dump all documents from the store."""
 
+    def iter_docs(self, batch_size: int) -> Iterator[List[Document]]:
+        """Iterate over all documents of the store in the order of dump,
+        batch_size at a time."""
+        docs = self.dump()
+        for i in range(0, len(docs), batch_size):
+            yield docs[i : i + batch_size]
+
     @abstractmethod
     def reset(self) -> None:
         """Delete all documents from the store."""
@@ -79,6 +140,15 @@ class DocStore(ABC):
     def exists(self) -> bool:
         """Check if the document store exists."""
 
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the store in bytes."""
+        return 0
+
+    def embedding_matrix(self) -> Optional[Tuple[Any, Dict[DocId, int]]]:
+        """Get the matrix holding all embeddings and the row of each id,
+        if the store keeps them in one."""
+        return None
+
 
 class VectorDocStore(DocStore):
     @abstractmethod
@@ -87,8 +157,42 @@ class VectorDocStore(DocStore):
     ) -> List[Document]:
         """Search for the k most similar documents."""
 
+    def query_ids_by_embedding(
+        self, embedding: Embedding, k: int
+    ) -> List[DocId]:
+        """Search for the ids of the k most similar documents."""
+        return [doc.id for doc in self.query_by_embedding(embedding, k)]
+
+    def query_ids_by_embeddings(
+        self, embeddings: List[Embedding], k: int
+    ) -> List[List[DocId]]:
+        """Search for the ids of the k most similar documents to each of
+        many embeddings."""
+        return [
+            self.query_ids_by_embedding(embedding, k)
+            for embedding in embeddings
+        ]
+
 
 class Embedder(ABC):
+    # whether the embedder is fitted to each book when it is indexed
+    per_book = False
+
+    @property
+    def name(self) -> str:
+        """Identify the embedding model, used to key cached embeddings."""
+        return type(self).__name__
+
+    def fit(self, texts: List[str]) -> None:
+        """Learn from all texts of a book before they are embedded."""
+
+    def load(self) -> None:
+        """Load the embedding model ahead of time."""
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the embedder in bytes."""
+        return 0
+
     @abstractmethod
     def embed_texts(self, texts: List[str]) -> List[Embedding]:
         """Create embeddings for the texts."""
@@ -97,6 +201,10 @@ class Embedder(ABC):
         """Create an embedding for a single text."""
         return self.embed_texts([text])[0]
 
+    def embed_queries(self, texts: List[str]) -> List[Embedding]:
+        """Create embeddings for many questions at once."""
+        return self.embed_texts(texts)
+
     def embed_docs(self, docs: List[Document]):
         """Create embeddings for the documents."""
         texts = [doc.content for doc in docs]
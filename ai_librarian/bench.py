@@ -0,0 +1,233 @@
+import contextlib
+import io
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# backends benchmarked by default, "bundle" is the index bundle opened
+# by BookStoreFactory.readonly whatever the backend
+BACKENDS = ["numpy", "chroma", "bundle"]
+
+WORDS = (
+    "alpha beta gamma delta river house town wall cathedral spire "
+    "fountain pigeon garden window letter morning evening winter summer "
+    "station train harbour ship captain doctor teacher student friend "
+    "mother father sister brother child village forest mountain valley "
+    "bridge market church school library book story dream memory light "
+    "shadow stone silver golden quiet ancient hidden broken distant"
+).split()
+
+
+def make_synthetic_book(path, chapters=20, paragraphs=30, seed=0):
+    """Write an EPUB of random sentences, the same for the same seed."""
+    from ebooklib import epub
+
+    rnd = random.Random(seed)
+    book = epub.EpubBook()
+    book.set_identifier(f"synthetic-{seed}-{chapters}-{paragraphs}")
+    book.set_title(f"Synthetic book {seed}")
+    book.set_language("en")
+
+    items = []
+    for chapter in range(chapters):
+        html = [f"<h1>Chapter {chapter + 1}</h1>"]
+        for _ in range(paragraphs):
+            sentences = [
+                _sentence(rnd, rnd.randint(5, 15))
+                for _ in range(rnd.randint(2, 6))
+            ]
+            html.append(f"<p>{' '.join(sentences)}</p>")
+
+        item = epub.EpubHtml(
+            title=f"Chapter {chapter + 1}",
+            file_name=f"chapter_{chapter}.xhtml",
+            lang="en",
+        )
+        item.content = f"<html><body>{''.join(html)}</body></html>"
+        book.add_item(item)
+        items.append(item)
+
+    book.toc = items
+    book.spine = ["nav"] + items
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(path, book)
+
+
+def make_queries(n, seed=0):
+    """Make questions in the vocabulary of the synthetic books."""
+    rnd = random.Random(seed)
+    return [_sentence(rnd, rnd.randint(3, 8)) for _ in range(n)]
+
+
+def _sentence(rnd, length):
+    words = [rnd.choice(WORDS) for _ in range(length)]
+    return " ".join(words).capitalize() + "."
+
+
+class CallCounter:
+    """Count the calls made to the methods of an object."""
+
+    def __init__(self, target):
+        self.target = target
+        self.calls = {}
+
+    def __getattr__(self, name):
+        value = getattr(self.target, name)
+        if not callable(value):
+            return value
+
+        def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return value(*args, **kwargs)
+
+        return counted
+
+
+def run_backend(book_file, backend, queries, k=4, quantization="none"):
+    """Index a book and time retrievals with one backend.
+
+    Meant to run in a process of its own, so that its peak RSS is not
+    mixed up with other backends."""
+    from .doc_store import BookStoreFactory
+    from .embedder import HashEmbedder
+    from .indexer import Indexer
+    from .retriever import ContextualBookRetriever
+
+    embedder = HashEmbedder()
+    with tempfile.TemporaryDirectory() as book_dir:
+        index_backend = "numpy" if backend == "bundle" else backend
+        indexer = Indexer(book_file, embedder, book_dir, index_backend)
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            indexer.index(force=True)
+        index_time = time.perf_counter() - started
+        docs = len(indexer.doc_store.dump())
+        chapters = len(indexer.loader.chapters)
+
+        started = time.perf_counter()
+        if backend == "bundle":
+            store = BookStoreFactory.readonly(
+                indexer.book_id, book_dir, index_backend, quantization
+            )
+        else:
+            store = BookStoreFactory.backend_readonly(
+                indexer.book_id, book_dir, backend, quantization
+            )
+        store = CallCounter(store)
+        store.load()
+        retriever = ContextualBookRetriever(embedder, store)
+        retriever.neighbors.warm_up()
+        load_time = time.perf_counter() - started
+        load_calls = dict(store.calls)
+
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            retriever.retrieve(query, k)
+            latencies.append(time.perf_counter() - started)
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "backend": backend,
+        "docs": docs,
+        "chapters": chapters,
+        "index_seconds": index_time,
+        "index_docs_per_second": docs / index_time,
+        "load_ms": load_time * 1000,
+        "queries": len(queries),
+        "retrieve_ms": {
+            "first": float(latencies_ms[0]) if len(latencies) else None,
+            "mean": float(latencies_ms.mean()) if len(latencies) else None,
+            "p50": _percentile(latencies_ms, 50),
+            "p95": _percentile(latencies_ms, 95),
+            "p99": _percentile(latencies_ms, 99),
+        },
+        "store_calls_load": load_calls,
+        "store_calls_per_query": {
+            name: (count - load_calls.get(name, 0)) / max(len(queries), 1)
+            for name, count in store.calls.items()
+            if count > load_calls.get(name, 0)
+        },
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _percentile(values, q):
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, q))
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def run_bench(
+    backends=BACKENDS,
+    chapters=20,
+    paragraphs=30,
+    n_queries=200,
+    k=4,
+    quantization="none",
+    seed=0,
+):
+    """Benchmark every backend on the same synthetic book."""
+    queries = make_queries(n_queries, seed)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        book_file = os.path.join(tmp_dir, "book.epub")
+        make_synthetic_book(book_file, chapters, paragraphs, seed)
+
+        # a fresh process per backend keeps peak RSS per backend
+        context = multiprocessing.get_context("spawn")
+        for backend in backends:
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                future = executor.submit(
+                    run_backend,
+                    book_file,
+                    backend,
+                    queries,
+                    k,
+                    quantization,
+                )
+                results.append(future.result())
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "version": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "chapters": chapters,
+            "paragraphs": paragraphs,
+            "queries": n_queries,
+            "k": k,
+            "quantization": quantization,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+
+        return version("ai-librarian")
+    except Exception:
+        return None
@@ -1,30 +1,91 @@
 from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import sqlite3
+import atexit
+import shutil
+import queue
 import json
+import datetime
+import uuid
 import os
 
-from .const import LIBRARIAN_DIR
+from .const import (
+    LIBRARIAN_DIR,
+    LIBRARIAN_POOL_SIZE,
+    LIBRARIAN_POOL_MEMORY_MB,
+    INDEX_WORKERS,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_MAX_ENTRIES,
+)
+from .answer_cache import AnswerCache
 from .indexer import Indexer
+from .loader import EpubBookLoader
+from .librarian_pool import LibrarianPool
+
+# seconds to wait for a lock held by another connection
+BUSY_TIMEOUT = 10
+# chat logs written in one transaction at most
+CHAT_LOG_BATCH_SIZE = 100
 
 
 class BookKeeper:
     """BookKeeper is a class that manages the database of books and chat logs."""
 
     _instance = None
+    _instance_lock = threading.Lock()
 
     @staticmethod
     def instance():
         """Get the singleton instance of the book keeper."""
-        if BookKeeper._instance is None:
-            BookKeeper._instance = BookKeeper()
+        with BookKeeper._instance_lock:
+            if BookKeeper._instance is None:
+                BookKeeper._instance = BookKeeper()
         return BookKeeper._instance
 
     def __init__(self, conf_dir=LIBRARIAN_DIR):
         """Initialize the book keeper with the path to the configuration directory."""
-        db_path = os.path.expanduser(conf_dir + "/library.db")
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.db_path = os.path.expanduser(conf_dir + "/library.db")
+        self.local = threading.local()
+        self.chat_log_writer = ChatLogWriter(self.connect)
+        atexit.register(self.chat_log_writer.flush)
+
+        self.answer_cache = AnswerCache(
+            self,
+            ANSWER_CACHE_THRESHOLD,
+            ANSWER_CACHE_TTL,
+            ANSWER_CACHE_MAX_ENTRIES,
+        )
         self.create_schema()
 
+        self.librarians = LibrarianPool(
+            LIBRARIAN_POOL_SIZE, LIBRARIAN_POOL_MEMORY_MB * 1024 * 1024
+        )
+
+        # indexing runs on its own small pool so it cannot starve askers
+        self.upload_dir = os.path.expanduser(conf_dir + "/uploads")
+        self.index_executor = ThreadPoolExecutor(
+            max_workers=INDEX_WORKERS, thread_name_prefix="indexer"
+        )
+
+    @property
+    def conn(self):
+        """Get the database connection of the current thread."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+        return conn
+
+    def connect(self):
+        """Open a new connection to the database."""
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT)
+        # WAL lets readers proceed while another connection writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
     def create_schema(self):
         """Create the database schema if it does not exist."""
         self.conn.execute(
@@ -49,21 +110,205 @@ class BookKeeper:
             );
             """
         )
+        self.conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS chat_logs_book
+            ON chat_logs (book_id, created_at);
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                book_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        self.answer_cache.create_schema(self.conn)
         self.conn.commit()
 
-    def add_book(self, name, book_file, force=False):
+    def add_book(self, name, book_file, force=False, progress=None):
         """Index a new book and add to library."""
-        indexer = Indexer(book_file)
+        indexer = Indexer(book_file, answer_cache=self.answer_cache)
         book_id = indexer.book_id
 
         if self.book_exists(book_id) and not force:
             raise ValueError("Book already exists.")
 
-        indexer.index(force=True)
+        indexer.index(force=True, progress=progress)
+        self.librarians.invalidate(book_id)
+        self.answer_cache.clear(book_id)
 
-        self.register_book(name, book_id)
+        if not self.book_exists(book_id):
+            self.register_book(name, book_id)
         return book_id
 
+    def submit_book(self, name, book_file, force=False):
+        """Queue a book for indexing in the background.
+
+        The book file is moved into the upload directory and removed
+        once the job finishes. Returns the job."""
+        book_id = EpubBookLoader(book_file).book_id()
+
+        if self.book_exists(book_id) and not force:
+            raise ValueError("Book already exists.")
+
+        for job in self.list_jobs(book_id):
+            if job["status"] in ("queued", "running"):
+                return job
+
+        job_id = str(uuid.uuid4())
+        os.makedirs(self.upload_dir, exist_ok=True)
+        ext_name = os.path.splitext(book_file)[1]
+        file_path = os.path.join(self.upload_dir, f"{job_id}{ext_name}")
+        shutil.move(book_file, file_path)
+
+        self.conn.execute(
+            """
+            INSERT INTO jobs (job_id, book_id, name, file_path, status)
+            VALUES (?, ?, ?, ?, 'queued')
+            """,
+            (job_id, book_id, name, file_path),
+        )
+        self.conn.commit()
+
+        self.index_executor.submit(self.run_index_job, job_id)
+        return self.get_job(job_id)
+
+    def claim_job(self, job_id):
+        """Mark a queued job as running, unless another worker of the
+        server already has."""
+        cursor = self.conn.execute(
+            """
+            UPDATE jobs
+            SET status = 'running', updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status = 'queued'
+            """,
+            (job_id,),
+        )
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    def run_index_job(self, job_id):
+        """Index the book of a queued job, recording its progress."""
+        if not self.claim_job(job_id):
+            return
+        job = self.get_job(job_id)
+
+        def progress(done, total):
+            self.update_job(job_id, progress=done / max(total, 1))
+
+        try:
+            self.add_book(
+                job["name"],
+                job["file_path"],
+                force=True,
+                progress=progress,
+            )
+            self.update_job(job_id, status="done", progress=1.0)
+        except Exception as e:
+            print(f"Indexing job {job_id} failed: {e}")
+            self.update_job(job_id, status="failed", error=str(e))
+        finally:
+            if os.path.exists(job["file_path"]):
+                os.remove(job["file_path"])
+
+    def requeue_interrupted_jobs(self):
+        """Queue the jobs left running by a server that stopped again.
+
+        A job running in a live worker looks the same, so call it once
+        when the server starts, before its workers run any job."""
+        self.conn.execute(
+            """
+            UPDATE jobs
+            SET status = 'queued', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running'
+            """
+        )
+        self.conn.commit()
+
+    def resume_jobs(self):
+        """Run the queued jobs, e.g. those interrupted by a restart.
+
+        Every worker of a server may call it, each job only runs in the
+        worker claiming it first."""
+        cursor = self.conn.execute(
+            """
+            SELECT job_id, file_path
+            FROM jobs
+            WHERE status = 'queued'
+            ORDER BY created_at
+            """
+        )
+        for job_id, file_path in cursor.fetchall():
+            if os.path.exists(file_path):
+                self.index_executor.submit(self.run_index_job, job_id)
+                continue
+
+            # the job may have just been run by another worker
+            self.conn.execute(
+                """
+                UPDATE jobs
+                SET status = 'failed', error = 'Book file is missing.',
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ? AND status = 'queued'
+                """,
+                (job_id,),
+            )
+            self.conn.commit()
+
+    def update_job(self, job_id, status=None, progress=None, error=None):
+        """Update the status, progress or error of a job."""
+        self.conn.execute(
+            """
+            UPDATE jobs
+            SET status = COALESCE(?, status),
+                progress = COALESCE(?, progress),
+                error = COALESCE(?, error),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+            """,
+            (status, progress, error, job_id),
+        )
+        self.conn.commit()
+
+    def get_job(self, job_id):
+        """Get an indexing job."""
+        cursor = self.conn.execute(
+            """
+            SELECT job_id, book_id, name, file_path, status, progress,
+                   error, created_at, updated_at
+            FROM jobs
+            WHERE job_id = ?
+            """,
+            (job_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("Job not found.")
+        return _job_to_dict(row)
+
+    def list_jobs(self, book_id):
+        """List the indexing jobs of a book."""
+        cursor = self.conn.execute(
+            """
+            SELECT job_id, book_id, name, file_path, status, progress,
+                   error, created_at, updated_at
+            FROM jobs
+            WHERE book_id = ?
+            ORDER BY created_at
+            """,
+            (book_id,),
+        )
+        return [_job_to_dict(row) for row in cursor.fetchall()]
+
     def deregister_book(self, book_id):
         """Remove a book from the book keeper."""
         self.conn.execute(
@@ -77,6 +322,8 @@ class BookKeeper:
 
     def delete_book(self, book_id):
         """Remove a book from the book keeper and delete its index."""
+        self.librarians.invalidate(book_id)
+        self.answer_cache.clear(book_id)
         self.clear_chat_logs(book_id)
         self.deregister_book(book_id)
         Indexer.unindex(book_id)
@@ -93,19 +340,36 @@ class BookKeeper:
         self.conn.commit()
 
     def add_chat_log(self, book_id, log_id, question, answer, extra):
-        """Add a chat log to the book keeper."""
-        extra = json.dumps(extra)
-        self.conn.execute(
-            """
-            INSERT INTO chat_logs (book_id, log_id, question, answer, extra)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (book_id, log_id, question, answer, extra),
-        )
-        self.conn.commit()
+        """Add a chat log to the book keeper.
+
+        The log is written in the background, call flush_chat_logs to
+        wait for it."""
+        self.add_chat_logs(book_id, [(log_id, question, answer, extra)])
+
+    def add_chat_logs(self, book_id, logs):
+        """Add (log_id, question, answer, extra) chat logs of a book,
+        written in the background in one transaction."""
+        rows = []
+        for log_id, question, answer, extra in logs:
+            # the time of the question rather than of the write, with
+            # enough precision to keep the order of questions asked in
+            # one second
+            created_at = datetime.datetime.utcnow().isoformat(
+                sep=" ", timespec="microseconds"
+            )
+            extra = json.dumps(extra)
+            rows.append(
+                (book_id, log_id, question, answer, extra, created_at)
+            )
+        self.chat_log_writer.put(rows)
+
+    def flush_chat_logs(self):
+        """Wait until all added chat logs are written."""
+        self.chat_log_writer.flush()
 
     def remove_chat_log(self, book_id, log_id):
         """Remove a chat log from the book keeper."""
+        self.flush_chat_logs()
         self.conn.execute(
             """
             DELETE FROM chat_logs
@@ -117,6 +381,7 @@ class BookKeeper:
 
     def clear_chat_logs(self, book_id):
         """Remove all chat logs for a book."""
+        self.flush_chat_logs()
         self.conn.execute(
             """
             DELETE FROM chat_logs
@@ -139,18 +404,44 @@ class BookKeeper:
             for book_id, name in cursor.fetchall()
         ]
 
-    def list_chat_logs(self, book_id):
-        """List all chat logs for a book."""
-        cursor = self.conn.execute(
-            """
+    def list_chat_logs(self, book_id, limit=None, before=None, since=None):
+        """List the chat logs for a book, oldest first.
+
+        Without a cursor the latest limit logs are listed. before and
+        since are log ids, listing the logs asked before or after them."""
+        self.flush_chat_logs()
+        query = """
             SELECT log_id, question, answer, extra
             FROM chat_logs
             WHERE book_id = ?
-            """,
-            (book_id,),
-        )
+        """
+        params = [book_id]
+        for log_id, op in ((before, "<"), (since, ">")):
+            if log_id is None:
+                continue
+            if not self.chat_log_exists(book_id, log_id):
+                raise ValueError(f"Unknown chat log {log_id}.")
+            query += f"""
+                AND (created_at, rowid) {op} (
+                    SELECT created_at, rowid
+                    FROM chat_logs
+                    WHERE book_id = ? AND log_id = ?
+                )
+            """
+            params += [book_id, log_id]
 
-        return [
+        # page from the cursor since starts at, otherwise from the latest
+        order = "ASC" if since is not None and before is None else "DESC"
+        query += f" ORDER BY created_at {order}, rowid {order}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        rows = self.conn.execute(query, params).fetchall()
+        if order == "DESC":
+            rows.reverse()
+
+        logs = [
             {
                 "book_id": book_id,
                 "log_id": log_id,
@@ -158,8 +449,42 @@ class BookKeeper:
                 "answer": answer,
                 **json.loads(extra),
             }
-            for log_id, question, answer, extra in cursor.fetchall()
+            for log_id, question, answer, extra in rows
         ]
+        self.resolve_rel_docs(book_id, logs)
+        return logs
+
+    def resolve_rel_docs(self, book_id, logs):
+        """Replace the logged rel_doc_ids with the referenced docs.
+
+        Logs written before the ids were logged already carry their
+        rel_docs and are left as they are."""
+        from .librarian import resolve_rel_docs
+
+        logged = [log for log in logs if "rel_doc_ids" in log]
+        if not logged:
+            return
+
+        rel_doc_ids_list = [log.pop("rel_doc_ids") for log in logged]
+        if self.book_exists(book_id):
+            rel_docs_list = resolve_rel_docs(book_id, rel_doc_ids_list)
+        else:
+            rel_docs_list = [[] for _ in logged]
+
+        for log, rel_docs in zip(logged, rel_docs_list):
+            log["rel_docs"] = rel_docs
+
+    def chat_log_exists(self, book_id, log_id):
+        """Check if a chat log exists."""
+        cursor = self.conn.execute(
+            """
+            SELECT log_id
+            FROM chat_logs
+            WHERE book_id = ? AND log_id = ?
+            """,
+            (book_id, log_id),
+        )
+        return cursor.fetchone() is not None
 
     def book_exists(self, book_id):
         """Check if a book exists."""
@@ -175,10 +500,99 @@ class BookKeeper:
 
     def get_librarian(self, book_id):
         """Get a librarian for a book."""
-        from .librarian import Librarian
-
         if self.book_exists(book_id):
-            return Librarian(book_id)
+            return self.librarians.get(book_id)
+
+    def hottest_books(self, limit):
+        """List the ids of the books with the most questions asked."""
+        cursor = self.conn.execute(
+            """
+            SELECT books.book_id
+            FROM books
+            LEFT JOIN chat_logs ON chat_logs.book_id = books.book_id
+            GROUP BY books.book_id
+            ORDER BY COUNT(chat_logs.log_id) DESC
+            LIMIT ?
+            """,
+            (limit,),
+        )
+        return [book_id for (book_id,) in cursor.fetchall()]
+
+    def preload_librarians(self, limit):
+        """Warm up librarians for the most asked-about books."""
+        self.librarians.preload(self.hottest_books(limit))
+
+
+class ChatLogWriter:
+    """Write chat logs in the background, batching them into one
+    transaction, so that logging stays off the request path."""
+
+    def __init__(self, connect):
+        """Create a writer opening its connection with connect."""
+        self.connect = connect
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, rows):
+        """Queue (book_id, log_id, question, answer, extra, created_at)
+        rows to write in the same transaction."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="chat-log-writer", daemon=True
+                )
+                self.thread.start()
+        self.queue.put(rows)
+
+    def flush(self):
+        """Wait until all queued rows are written."""
+        self.queue.join()
+
+    def run(self):
+        conn = self.connect()
+        while True:
+            batches = [self.queue.get()]
+            rows = list(batches[0])
+            while len(rows) < CHAT_LOG_BATCH_SIZE:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                rows.extend(batches[-1])
+
+            try:
+                with conn:
+                    conn.executemany(
+                        """
+                        INSERT INTO chat_logs (
+                            book_id, log_id, question, answer, extra,
+                            created_at
+                        )
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        rows,
+                    )
+            except sqlite3.Error as e:
+                print(f"Failed to write {len(rows)} chat logs: {e}")
+            finally:
+                for _ in batches:
+                    self.queue.task_done()
+
+
+def _job_to_dict(row):
+    keys = [
+        "job_id",
+        "book_id",
+        "name",
+        "file_path",
+        "status",
+        "progress",
+        "error",
+        "created_at",
+        "updated_at",
+    ]
+    return dict(zip(keys, row))
 
 
 if __name__ == "__main__":
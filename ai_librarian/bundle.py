@@ -0,0 +1,433 @@
+import mmap
+import json
+import os
+import shutil
+
+import numpy as np
+
+from typing import List, Any, Tuple, Dict, Iterator
+
+from .base import VectorDocStore, Document, DocId, Embedding
+from .const import STORE_RERANK_FACTOR
+from .quantization import (
+    QuantizedMatrix,
+    top_k,
+    top_k_many,
+    reranked_top_k,
+)
+
+BUNDLE_FILE = "index.bundle"
+
+MAGIC = b"ALIBNDL1"
+VERSION = 1
+# sections start at multiples of this, so the arrays can be mapped
+ALIGNMENT = 64
+
+# bytes copied at once from the spooled sections into the bundle
+COPY_BUFFER_SIZE = 1 << 20
+
+# metadata kept as arrays, -1 standing for None
+INT_KEYS = ["chapter_index", "start", "end"]
+# metadata linking to other documents, kept as row numbers
+LINK_KEYS = ["prev_id", "next_id", "parent_id"]
+
+
+def bundle_path(book_dir: str) -> str:
+    """Get the path of the index bundle of a book."""
+    return os.path.join(book_dir, BUNDLE_FILE)
+
+
+def write_bundle(path: str, docs: List[Document]) -> None:
+    """Write documents to a bundle file, replacing it atomically.
+
+    A bundle is a json header followed by aligned sections: the float32
+    embedding matrix, the ids and contents as utf-8 blobs with offsets,
+    the links and offsets as integer arrays and the rest of the metadata
+    as json."""
+    with BundleWriter(path) as writer:
+        writer.add(docs)
+        writer.finish()
+
+
+class BundleWriter:
+    """Write a bundle file a batch of documents at a time.
+
+    The sections are spooled to temporary files next to the bundle and
+    joined behind the header by finish, so only the ids and links of
+    the documents are held in memory, not their embeddings and texts.
+    Leaving the writer without finishing removes the spooled files."""
+
+    def __init__(self, path: str):
+        """Start writing the bundle at path."""
+        self.path = path
+        self.ids: List[DocId] = []
+        self.links: Dict[str, List[Any]] = {key: [] for key in LINK_KEYS}
+        # section name -> (spool file, dtype, shape of a row, rows)
+        self.spools: Dict[str, list] = {}
+        self.string_sizes: Dict[str, int] = {}
+
+    def __enter__(self) -> "BundleWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._remove_spools()
+
+    def add(self, docs: List[Document]) -> None:
+        """Append documents to the bundle."""
+        if len(docs) == 0:
+            return
+
+        self._write(
+            "embeddings",
+            np.asarray([doc.embedding for doc in docs], np.float32),
+        )
+        self._write_strings("ids", [doc.id for doc in docs])
+        self._write_strings("texts", [doc.content for doc in docs])
+        for key in INT_KEYS:
+            self._write(
+                key,
+                np.array(
+                    [_int(doc.metadata.get(key)) for doc in docs],
+                    dtype=np.int64,
+                ),
+            )
+        self._write_strings(
+            "extras",
+            [json.dumps(_extra_metadata(doc.metadata)) for doc in docs],
+        )
+
+        self.ids.extend(doc.id for doc in docs)
+        for key in LINK_KEYS:
+            self.links[key].extend(doc.metadata.get(key) for doc in docs)
+
+    def _write(self, name: str, array: np.ndarray) -> None:
+        if name not in self.spools:
+            spool = open(f"{self.path}.{name}.tmp", "w+b")
+            self.spools[name] = [spool, array.dtype, array.shape[1:], 0]
+        spool = self.spools[name]
+        spool[0].write(np.ascontiguousarray(array).tobytes())
+        spool[3] += len(array)
+
+    def _write_strings(self, name: str, values: List[str]) -> None:
+        encoded = [value.encode() for value in values]
+        if name not in self.string_sizes:
+            self.string_sizes[name] = 0
+            self._write(f"{name}_offsets", np.zeros(1, dtype=np.uint64))
+
+        ends = np.cumsum(
+            [len(value) for value in encoded], dtype=np.uint64
+        )
+        ends += np.uint64(self.string_sizes[name])
+        self.string_sizes[name] = int(ends[-1])
+        self._write(f"{name}_offsets", ends)
+        self._write(
+            f"{name}_blob",
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        )
+
+    def finish(self) -> None:
+        """Write the bundle file from the documents added, replacing it
+        atomically."""
+        if len(self.ids) == 0:
+            raise ValueError("Cannot write an empty bundle.")
+
+        rows = {id_: i for i, id_ in enumerate(self.ids)}
+        links = {
+            key: np.array(
+                [rows.get(id_, -1) for id_ in self.links[key]],
+                dtype=np.int32,
+            )
+            for key in LINK_KEYS
+        }
+
+        # the sections in the order readers have always found them
+        names = ["embeddings", "ids_offsets", "ids_blob"]
+        names += ["texts_offsets", "texts_blob", *INT_KEYS, *LINK_KEYS]
+        names += ["extras_offsets", "extras_blob"]
+
+        header = {
+            "version": VERSION,
+            "count": len(self.ids),
+            "dim": self.spools["embeddings"][2][0],
+            "sections": {},
+        }
+        offset = 0
+        for name in names:
+            if name in links:
+                dtype, shape = links[name].dtype, links[name].shape
+            else:
+                _, dtype, row_shape, count = self.spools[name]
+                shape = (count, *row_shape)
+            header["sections"][name] = {
+                "offset": offset,
+                "dtype": dtype.str,
+                "shape": list(shape),
+            }
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            offset = _aligned(offset + nbytes)
+
+        header_bytes = json.dumps(header).encode()
+        data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for name in names:
+                f.seek(data_start + header["sections"][name]["offset"])
+                if name in links:
+                    f.write(links[name].tobytes())
+                else:
+                    spool = self.spools[name][0]
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, f, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, self.path)
+        self._remove_spools()
+
+    def _remove_spools(self) -> None:
+        for spool, *_ in self.spools.values():
+            spool.close()
+            os.remove(spool.name)
+        self.spools = {}
+
+
+def _int(value: Any) -> int:
+    return -1 if value is None else value
+
+
+def _extra_metadata(metadata: dict) -> dict:
+    return {
+        k: v
+        for k, v in metadata.items()
+        if k not in INT_KEYS and k not in LINK_KEYS and v is not None
+    }
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class BundleDocStore(VectorDocStore):
+    """A readonly document store over a memory-mapped bundle file.
+
+    Loading only parses the header and maps the sections, documents
+    are decoded from the mapping when they are asked for."""
+
+    @staticmethod
+    def new_local_readonly(path: str, quantization: str = "none"):
+        """Open the bundle at path."""
+        return BundleDocStore(path, quantization)
+
+    def __init__(self, path, quantization="none"):
+        """Create a new BundleDocStore."""
+        self.path = path
+        self.quantization = quantization
+        self.readonly = True
+        self.loaded = False
+        self.mm = None
+        self.sections = {}
+        self.blob_starts = {}
+        self.count = 0
+        self.id_index = None
+        self.quantized = None
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def load(self) -> None:
+        """Map the bundle file."""
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not an index bundle.")
+        header_size = int.from_bytes(
+            mm[len(MAGIC) : len(MAGIC) + 8], "little"
+        )
+        header_start = len(MAGIC) + 8
+        header = json.loads(mm[header_start : header_start + header_size])
+        if header["version"] != VERSION:
+            raise ValueError(
+                f"Unsupported bundle version {header['version']}."
+            )
+
+        data_start = _aligned(header_start + header_size)
+        sections = {}
+        blob_starts = {}
+        for name, section in header["sections"].items():
+            if name.endswith("_blob"):
+                blob_starts[name[: -len("_blob")]] = (
+                    data_start + section["offset"]
+                )
+            dtype = np.dtype(section["dtype"])
+            shape = tuple(section["shape"])
+            sections[name] = np.frombuffer(
+                mm,
+                dtype=dtype,
+                count=int(np.prod(shape)),
+                offset=data_start + section["offset"],
+            ).reshape(shape)
+
+        self.mm = mm
+        self.sections = sections
+        self.blob_starts = blob_starts
+        self.count = header["count"]
+        self.id_index = None
+        self.quantized = None
+        if self.quantization != "none" and self.count > 0:
+            self.quantized = QuantizedMatrix(
+                sections["embeddings"], self.quantization
+            )
+        self.loaded = True
+
+    def _strings(self, name: str, rows: np.ndarray) -> List[str]:
+        offsets = self.sections[f"{name}_offsets"]
+        base = self.blob_starts[name]
+        starts = offsets[rows].tolist()
+        ends = offsets[rows + 1].tolist()
+        return [
+            self.mm[base + start : base + end].decode()
+            for start, end in zip(starts, ends)
+        ]
+
+    def _ids(self, rows: Any) -> List[DocId]:
+        return self._strings("ids", np.asarray(rows, dtype=np.intp))
+
+    def _docs(self, rows: Any) -> List[Document]:
+        """Decode the documents at rows, a column at a time."""
+        rows = np.asarray(rows, dtype=np.intp)
+        ids = self._strings("ids", rows)
+        texts = self._strings("texts", rows)
+        extras = self._strings("extras", rows)
+        ints = {key: self.sections[key][rows].tolist() for key in INT_KEYS}
+        links = {key: self.sections[key][rows] for key in LINK_KEYS}
+
+        linked = np.unique(np.concatenate(list(links.values())))
+        linked = linked[linked >= 0]
+        linked_ids = dict(zip(linked.tolist(), self._ids(linked)))
+        links = {key: value.tolist() for key, value in links.items()}
+
+        # the extra metadata is mostly the same within a chapter
+        parsed_extras = {extra: json.loads(extra) for extra in set(extras)}
+
+        embeddings = self.sections["embeddings"]
+        docs = []
+        for j, row in enumerate(rows.tolist()):
+            metadata = dict(parsed_extras[extras[j]])
+            for key in INT_KEYS:
+                if ints[key][j] >= 0:
+                    metadata[key] = ints[key][j]
+            for key in LINK_KEYS:
+                if links[key][j] >= 0:
+                    metadata[key] = linked_ids[links[key][j]]
+
+            docs.append(
+                Document(
+                    id=ids[j],
+                    content=texts[j],
+                    metadata=metadata,
+                    embedding=embeddings[row],
+                )
+            )
+        return docs
+
+    def _rows(self) -> Dict[DocId, int]:
+        if self.id_index is None:
+            ids = self._ids(np.arange(self.count))
+            self.id_index = {id_: i for i, id_ in enumerate(ids)}
+        return self.id_index
+
+    def _top_k(self, embedding: Embedding, k: int) -> np.ndarray:
+        self._ensure_loaded()
+        if self.count == 0:
+            return np.zeros(0, dtype=np.intp)
+
+        matrix = self.sections["embeddings"]
+        query = np.asarray(embedding, dtype=np.float32)
+        if self.quantized is None:
+            return top_k(matrix @ query, k)
+
+        return reranked_top_k(
+            self.quantized, matrix, query, k, k * STORE_RERANK_FACTOR
+        )
+
+    def query_by_embedding(
+        self, embedding: Embedding, k: int, **kwargs: Any
+    ) -> List[Document]:
+        """Query the document store by embedding."""
+        if kwargs:
+            raise NotImplementedError(
+                f"Unsupported query options: {list(kwargs)}"
+            )
+        return self._docs(self._top_k(embedding, k))
+
+    def query_ids_by_embedding(
+        self, embedding: Embedding, k: int
+    ) -> List[DocId]:
+        """Query the ids of the most similar documents."""
+        return self._ids(self._top_k(embedding, k))
+
+    def query_ids_by_embeddings(
+        self, embeddings: List[Embedding], k: int
+    ) -> List[List[DocId]]:
+        """Query the ids of the most similar documents to each of many
+        embeddings."""
+        self._ensure_loaded()
+        if self.quantized is not None or self.count == 0:
+            return super().query_ids_by_embeddings(embeddings, k)
+
+        queries = np.asarray(embeddings, dtype=np.float32)
+        matrix = self.sections["embeddings"]
+        return [self._ids(top) for top in top_k_many(matrix, queries, k)]
+
+    def put(self, docs: List[Document]) -> None:
+        """Save documents to the store."""
+        raise Exception("Cannot put documents in a readonly store.")
+
+    def get(self, ids: List[DocId]) -> List[Document]:
+        """Load documents from the store."""
+        self._ensure_loaded()
+        rows = self._rows()
+        return self._docs([rows[id_] for id_ in ids if id_ in rows])
+
+    def dump(self) -> List[Document]:
+        """Dump all documents from the store."""
+        self._ensure_loaded()
+        return self._docs(np.arange(self.count))
+
+    def iter_docs(self, batch_size: int) -> Iterator[List[Document]]:
+        """Iterate over all documents of the store in the order of dump,
+        batch_size at a time."""
+        self._ensure_loaded()
+        for start in range(0, self.count, batch_size):
+            end = min(start + batch_size, self.count)
+            yield self._docs(np.arange(start, end))
+
+    def reset(self) -> None:
+        """Reset the document store."""
+        raise Exception("Cannot reset a readonly store.")
+
+    def save(self) -> None:
+        """Save the document store to disk."""
+        raise Exception("A readonly store cannot be saved.")
+
+    def exists(self) -> bool:
+        """Check if the document store exists."""
+        if not os.path.exists(self.path):
+            return False
+        self._ensure_loaded()
+        return self.count > 0
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the store in bytes."""
+        # the mapped sections are in the page cache, not held by us
+        if self.quantized is None:
+            return 0
+        return self.quantized.nbytes
+
+    def embedding_matrix(self) -> Tuple[Any, Dict[DocId, int]]:
+        """Get the matrix holding all embeddings and the row of each id."""
+        self._ensure_loaded()
+        return self.sections["embeddings"], self._rows()
@@ -2,20 +2,33 @@ import click
 
 import sys
 import os
-
-from .librarian import Librarian, interactive, interactive_debug_query
-from .indexer import Indexer
-from .loader import EpubBookLoader
+import json
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    "--profile-startup",
+    is_flag=True,
+    help="Report the time spent importing each module on exit",
+)
+def cli(profile_startup):
+    # commands import what they use, so that each one only pays for it
+    if profile_startup:
+        import atexit
+
+        from .import_profile import ImportProfiler
+
+        profiler = ImportProfiler()
+        profiler.install()
+        atexit.register(profiler.report)
 
 
 @cli.command(help="Start asking questions about the book")
 @click.option("-f", "--file", required=True, help="Path to the epub file")
 def chat(file):
+    from .librarian import Librarian, interactive
+    from .loader import EpubBookLoader
+
     book_id = EpubBookLoader(file).book_id()
     librarian = Librarian(book_id)
     interactive(librarian)
@@ -24,19 +37,155 @@ def chat(file):
 @cli.command(help="Debug a query")
 @click.option("-f", "--file", required=True, help="Path to the epub file")
 def debug_query(file):
+    from .librarian import Librarian, interactive_debug_query
+    from .loader import EpubBookLoader
+
     book_id = EpubBookLoader(file).book_id()
     librarian = Librarian(book_id)
     interactive_debug_query(librarian)
 
 
+@cli.command(help='Search the book for words or a "quoted phrase"')
+@click.option("-f", "--file", required=True, help="Path to the epub file")
+@click.option("-k", default=5, help="Number of documents to show")
+@click.argument("query")
+def search(file, k, query):
+    from .librarian import Librarian
+    from .loader import EpubBookLoader
+
+    book_id = EpubBookLoader(file).book_id()
+    librarian = Librarian(book_id)
+    for doc in librarian.search(query, k):
+        chapter = doc["metadata"].get("chapter_title")
+        print(f"[Document {doc['id']} from chapter {chapter}]")
+        print(doc["content"].strip())
+        print()
+
+
 @cli.command(help="Rebuild the index")
 @click.option("-f", "--file", required=True, help="Path to the epub file")
 def rebuild(file):
-    indexer = Indexer(file)
+    from .book_keeper import BookKeeper
+    from .indexer import Indexer
+
+    # answers cached with the old index would no longer match
+    indexer = Indexer(
+        file, answer_cache=BookKeeper.instance().answer_cache
+    )
     indexer.index(force=True)
     print("Rebuilt index.")
 
 
+@cli.command(help="Convert indexed books to index bundles")
+@click.option(
+    "-f",
+    "--file",
+    "files",
+    multiple=True,
+    help="Path to the epub file, all books if not given",
+)
+@click.option(
+    "-b",
+    "--backend",
+    type=click.Choice(["chroma", "numpy"]),
+    default=lambda: os.environ.get("STORE_BACKEND", "chroma"),
+    help="Backend the books were indexed with",
+)
+def bundle(files, backend):
+    from .book_keeper import BookKeeper
+    from .doc_store import BookStoreFactory
+    from .loader import EpubBookLoader
+    from .util import get_book_dir
+
+    if files:
+        book_ids = [EpubBookLoader(file).book_id() for file in files]
+    else:
+        books = BookKeeper.instance().list_books()
+        book_ids = [book["book_id"] for book in books]
+
+    for book_id in book_ids:
+        path = BookStoreFactory.convert_to_bundle(
+            book_id, get_book_dir(book_id), backend
+        )
+        print(f"Wrote {path}.")
+
+
+@cli.command(help="Measure the recall of quantized search")
+@click.option("-f", "--file", required=True, help="Path to the epub file")
+@click.option(
+    "-q",
+    "--quantization",
+    type=click.Choice(["float16", "int8"]),
+    multiple=True,
+    default=["float16", "int8"],
+    help="Quantization modes to compare with exact search",
+)
+@click.option("-k", default=10, help="Results per query")
+@click.option("-n", "--queries", default=200, help="Number of queries")
+def recall(file, quantization, k, queries):
+    import numpy as np
+
+    from .const import STORE_RERANK_FACTOR
+    from .doc_store import BookStoreFactory
+    from .loader import EpubBookLoader
+    from .quantization import recall_report
+    from .util import get_book_dir
+
+    book_id = EpubBookLoader(file).book_id()
+    store = BookStoreFactory.readonly(
+        book_id, get_book_dir(book_id), quantization="none"
+    )
+    matrix = np.asarray(
+        [doc.embedding for doc in store.dump()], dtype=np.float32
+    )
+    if len(matrix) == 0:
+        raise click.ClickException("The book is not indexed.")
+
+    reports = [
+        recall_report(matrix, mode, k, STORE_RERANK_FACTOR, queries)
+        for mode in quantization
+    ]
+    print(json.dumps(reports, indent=2))
+
+
+@cli.command(help="Benchmark indexing and retrieval on a synthetic book")
+@click.option(
+    "-b",
+    "--backend",
+    "backends",
+    type=click.Choice(["numpy", "chroma", "bundle"]),
+    multiple=True,
+    default=["numpy", "chroma", "bundle"],
+    help="Backends to benchmark",
+)
+@click.option("--chapters", default=20, help="Chapters of the book")
+@click.option("--paragraphs", default=30, help="Paragraphs per chapter")
+@click.option("-n", "--queries", default=200, help="Number of queries")
+@click.option("-k", default=4, help="Documents retrieved per query")
+@click.option(
+    "-q",
+    "--quantization",
+    type=click.Choice(["none", "float16", "int8"]),
+    default="none",
+    help="Quantization of the numpy and bundle stores",
+)
+@click.option("--seed", default=0, help="Seed of the book and queries")
+@click.option("-o", "--output", help="Write the JSON report to a file")
+def bench(
+    backends, chapters, paragraphs, queries, k, quantization, seed, output
+):
+    from .bench import run_bench
+
+    report = run_bench(
+        backends, chapters, paragraphs, queries, k, quantization, seed
+    )
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
 @cli.command(help="Start web interface")
 @click.option(
     "-h", "--host", default=lambda: os.environ.get("HOST", "127.0.0.1")
@@ -45,6 +194,10 @@ def rebuild(file):
     "-p", "--port", default=lambda: os.environ.get("PORT", "5000")
 )
 def web(host, port):
+    from .book_keeper import BookKeeper
+
+    BookKeeper.instance().requeue_interrupted_jobs()
+
     from .web import app
 
     app.run(host=host, port=int(port))
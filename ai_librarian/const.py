@@ -5,3 +5,81 @@ DEFAULT_LIBRARIAN_DIR = "~/.cache/librarian"
 LIBRARIAN_DIR = os.path.expanduser(
     os.environ.get("DATA_DIR", DEFAULT_LIBRARIAN_DIR)
 )
+
+# Which VectorDocStore implementation backs a book: "chroma" or "numpy"
+STORE_BACKEND = os.environ.get("STORE_BACKEND", "chroma")
+
+# Precision of the embeddings a numpy store keeps in memory: "none"
+# (float32), "float16" or "int8", searched with an exact re-rank
+STORE_QUANTIZATION = os.environ.get("STORE_QUANTIZATION", "none")
+# Candidates re-ranked per result by a quantized store
+STORE_RERANK_FACTOR = int(os.environ.get("STORE_RERANK_FACTOR", "4"))
+
+# Which embedder indexes books and questions: "openai" or "local", a
+# CPU-only tf-idf embedder fitted to each book
+EMBEDDER = os.environ.get("EMBEDDER", "openai")
+# Dimensions of the local embedder and number of hashed terms it counts
+LOCAL_EMBEDDING_DIM = int(os.environ.get("LOCAL_EMBEDDING_DIM", "256"))
+LOCAL_EMBEDDING_FEATURES = int(
+    os.environ.get("LOCAL_EMBEDDING_FEATURES", "32768")
+)
+
+# Weight of relevance against diversity when picking the candidates of
+# a question by maximal marginal relevance, 1 only looks at relevance
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", "0.5"))
+
+# Constant of the reciprocal rank fusion of embedding and BM25 search
+# results, higher lets lower ranks count more, 0 disables BM25 search
+LEXICAL_FUSION_K = int(os.environ.get("LEXICAL_FUSION_K", "60"))
+
+# Upper bound of embeddings kept in the on-disk embedding cache
+EMBEDDING_CACHE_MAX_ENTRIES = int(
+    os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "200000")
+)
+
+# Number of query embeddings kept in memory
+QUERY_CACHE_MAX_ENTRIES = int(
+    os.environ.get("QUERY_CACHE_MAX_ENTRIES", "1024")
+)
+
+# Number of embedding API requests in flight at once while indexing
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "4"))
+
+# Warm librarians kept by the web server, bounded by count and memory
+LIBRARIAN_POOL_SIZE = int(os.environ.get("LIBRARIAN_POOL_SIZE", "8"))
+LIBRARIAN_POOL_MEMORY_MB = int(
+    os.environ.get("LIBRARIAN_POOL_MEMORY_MB", "2048")
+)
+# Number of most asked-about books to load when the web server starts
+LIBRARIAN_POOL_PRELOAD = int(os.environ.get("LIBRARIAN_POOL_PRELOAD", "0"))
+
+# Chat completions in flight at once while answering a batch of
+# questions
+CHAT_CONCURRENCY = int(os.environ.get("CHAT_CONCURRENCY", "4"))
+
+# Most questions asked at once in a batch, so a request does not hold
+# a worker past proxy timeouts
+ASK_BATCH_MAX_SIZE = int(os.environ.get("ASK_BATCH_MAX_SIZE", "20"))
+
+# Number of books indexed at once by the web server
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", "1"))
+
+# Questions at least this similar to an answered one reuse its answer,
+# set above 1 to disable the answer cache
+ANSWER_CACHE_THRESHOLD = float(
+    os.environ.get("ANSWER_CACHE_THRESHOLD", "0.97")
+)
+# Seconds an answer is reused for
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "604800"))
+# Answers kept per book
+ANSWER_CACHE_MAX_ENTRIES = int(
+    os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1000")
+)
+
+# Chat logs returned by one history request unless a limit is given
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "100"))
+
+# Most chat logs returned by one history request, whatever the limit
+HISTORY_MAX_PAGE_SIZE = int(
+    os.environ.get("HISTORY_MAX_PAGE_SIZE", "1000")
+)
@@ -1,21 +1,41 @@
-import chromadb
 import numpy as np
+import threading
+import json
 import os
 
-from typing import List, Any
+from typing import List, Any, Optional, Tuple, Dict, Iterator
 
-from .base import VectorDocStore, Document, DocId, Embedding
+from .base import (
+    VectorDocStore,
+    Document,
+    DocumentBatch,
+    DocId,
+    Embedding,
+)
+from .const import STORE_BACKEND, STORE_QUANTIZATION, STORE_RERANK_FACTOR
+from .quantization import (
+    QuantizedMatrix,
+    top_k,
+    top_k_many,
+    reranked_top_k,
+)
+from .bundle import BundleDocStore, BundleWriter, bundle_path
+
+# documents read from a store at once to convert it to a bundle
+CONVERT_BATCH_SIZE = 1000
 
 
 class ChromaDocStore(VectorDocStore):
     """A document store backed by ChromaDB."""
 
-    client: chromadb.Client
+    client: "chromadb.Client"
     collection_name: str
 
     @staticmethod
     def new_local(collection_name: str, persist_directory: str):
         """Create a new ChromaDocStore backed by a local directory."""
+        import chromadb
+
         settings = chromadb.config.Settings(
             chroma_db_impl="duckdb+parquet",
             persist_directory=persist_directory,
@@ -40,18 +60,24 @@ class ChromaDocStore(VectorDocStore):
         self.client = client
         self.collection_name = collection_name
         self.readonly = False
+        self._collection = None
 
     def collection(self):
         """Get the ChromaDB collection."""
+        if self._collection is not None:
+            return self._collection
+
         if self.readonly:
-            return self.client.get_collection(
+            self._collection = self.client.get_collection(
                 self.collection_name, embedding_function=dummy_embedding
             )
+        else:
+            self._collection = self.client.get_or_create_collection(
+                self.collection_name,
+                embedding_function=dummy_embedding,
+            )
 
-        return self.client.get_or_create_collection(
-            self.collection_name,
-            embedding_function=dummy_embedding,
-        )
+        return self._collection
 
     def query_by_embedding(
         self, embedding: Embedding, k: int, **kwargs: Any
@@ -59,7 +85,7 @@ class ChromaDocStore(VectorDocStore):
         """Query the document store by embedding."""
         coll = self.collection()
         results = coll.query(
-            query_embeddings=[list(embedding)],
+            query_embeddings=[np.asarray(embedding).tolist()],
             n_results=k,
             include=["metadatas", "documents", "embeddings"],
             **kwargs,
@@ -70,6 +96,34 @@ class ChromaDocStore(VectorDocStore):
         results["embeddings"] = results["embeddings"][0]
         return _results_to_docs(results)
 
+    def query_ids_by_embedding(
+        self, embedding: Embedding, k: int
+    ) -> List[DocId]:
+        """Query the ids of the most similar documents."""
+        coll = self.collection()
+        results = coll.query(
+            query_embeddings=[np.asarray(embedding).tolist()],
+            n_results=k,
+            include=["distances"],
+        )
+        return results["ids"][0]
+
+    def query_ids_by_embeddings(
+        self, embeddings: List[Embedding], k: int
+    ) -> List[List[DocId]]:
+        """Query the ids of the most similar documents to each of many
+        embeddings in one query."""
+        if len(embeddings) == 0:
+            return []
+
+        coll = self.collection()
+        results = coll.query(
+            query_embeddings=np.asarray(embeddings).tolist(),
+            n_results=k,
+            include=["distances"],
+        )
+        return results["ids"]
+
     def put(self, docs: List[Document]) -> None:
         """Save documents to the store."""
         if self.readonly:
@@ -89,12 +143,7 @@ class ChromaDocStore(VectorDocStore):
                 {k: v for k, v in doc.metadata.items() if v is not None}
             )
             ids.append(doc.id)
-            embeddings.append(list(doc.embedding))
-
-        print(documents)
-        print(metadatas)
-        print(ids)
-        print(embeddings)
+            embeddings.append(np.asarray(doc.embedding).tolist())
 
         coll = self.collection()
         coll.add(
@@ -120,11 +169,20 @@ class ChromaDocStore(VectorDocStore):
         )
         return _results_to_docs(results)
 
+    def iter_docs(self, batch_size: int) -> Iterator[List[Document]]:
+        """Iterate over all documents of the store, batch_size at a
+        time."""
+        # chroma pages in no stable order, so page through the ids
+        ids = self.collection().get(include=[])["ids"]
+        for start in range(0, len(ids), batch_size):
+            yield self.get(ids[start : start + batch_size])
+
     def reset(self) -> None:
         """Reset the document store."""
         if self.readonly:
             raise Exception("Cannot reset a readonly store.")
         self.client.delete_collection(self.collection_name)
+        self._collection = None
 
     def load(self) -> None:
         """Load the document store from disk."""
@@ -173,10 +231,534 @@ def dummy_embedding(_any):
     raise NotImplementedError("should be unreachable!")
 
 
+class NumpyDocStore(VectorDocStore):
+    """A document store keeping all embeddings in one in-memory matrix.
+
+    A book only has a few thousand chunks, so a brute-force search over
+    a contiguous float32 matrix is much cheaper than a round-trip
+    through a database.
+
+    With quantization set to "float16" or "int8" only a quantized copy
+    of the matrix is kept in memory. The float32 matrix is memory-mapped
+    from disk to re-rank the shortlist found in the quantized one."""
+
+    EMBEDDINGS_FILE = "embeddings.npy"
+    DOCS_FILE = "docs.json"
+
+    @staticmethod
+    def new_local(persist_directory: str, quantization: str = "none"):
+        """Create a new NumpyDocStore backed by a local directory."""
+        return NumpyDocStore(persist_directory, quantization)
+
+    @staticmethod
+    def new_local_readonly(
+        persist_directory: str, quantization: str = "none"
+    ):
+        """Create a readonly NumpyDocStore backed by a local directory."""
+        store = NumpyDocStore(persist_directory, quantization)
+        store.readonly = True
+        return store
+
+    def __init__(self, persist_directory, quantization="none"):
+        """Create a new NumpyDocStore."""
+        self.persist_directory = persist_directory
+        self.quantization = quantization
+        self.readonly = False
+        self.loaded = False
+        self._clear()
+
+    def _clear(self):
+        self.ids: List[DocId] = []
+        self.contents: List[str] = []
+        self.metadatas: List[dict] = []
+        self.id_index = {}
+        self.embeddings = None
+        # embeddings put since the matrix was last consolidated
+        self.pending_embeddings = []
+        self.quantized = None
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _matrix(self) -> np.ndarray:
+        """Get the embedding matrix, consolidating pending rows."""
+        if self.pending_embeddings:
+            parts = self.pending_embeddings
+            if self.embeddings is not None:
+                parts = [self.embeddings] + parts
+            self.embeddings = np.ascontiguousarray(
+                np.vstack(parts), dtype=np.float32
+            )
+            self.pending_embeddings = []
+            self.quantized = None
+
+        if self.embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        return self.embeddings
+
+    def _doc(self, i: int, matrix: np.ndarray) -> Document:
+        return Document(
+            id=self.ids[i],
+            content=self.contents[i],
+            metadata=self.metadatas[i].copy(),
+            embedding=matrix[i],
+        )
+
+    def query_by_embedding(
+        self, embedding: Embedding, k: int, **kwargs: Any
+    ) -> List[Document]:
+        """Query the document store by embedding."""
+        if kwargs:
+            raise NotImplementedError(
+                f"Unsupported query options: {list(kwargs)}"
+            )
+
+        matrix = self._matrix()
+        return [self._doc(i, matrix) for i in self._top_k(embedding, k)]
+
+    def query_ids_by_embedding(
+        self, embedding: Embedding, k: int
+    ) -> List[DocId]:
+        """Query the ids of the most similar documents."""
+        return [self.ids[i] for i in self._top_k(embedding, k)]
+
+    def query_ids_by_embeddings(
+        self, embeddings: List[Embedding], k: int
+    ) -> List[List[DocId]]:
+        """Query the ids of the most similar documents to each of many
+        embeddings."""
+        self._ensure_loaded()
+        if self.quantization != "none" or len(self.ids) == 0:
+            return super().query_ids_by_embeddings(embeddings, k)
+
+        queries = np.asarray(embeddings, dtype=np.float32)
+        return [
+            [self.ids[i] for i in top]
+            for top in top_k_many(self._matrix(), queries, k)
+        ]
+
+    def _top_k(self, embedding: Embedding, k: int) -> np.ndarray:
+        self._ensure_loaded()
+        matrix = self._matrix()
+        if len(self.ids) == 0:
+            return np.zeros(0, dtype=np.intp)
+
+        query = np.asarray(embedding, dtype=np.float32)
+        if self.quantization == "none":
+            return top_k(matrix @ query, k)
+
+        if self.quantized is None:
+            self.quantized = QuantizedMatrix(matrix, self.quantization)
+        return reranked_top_k(
+            self.quantized, matrix, query, k, k * STORE_RERANK_FACTOR
+        )
+
+    def embedding_matrix(self) -> Tuple[Any, Dict[DocId, int]]:
+        """Get the matrix holding all embeddings and the row of each id."""
+        self._ensure_loaded()
+        return self._matrix(), self.id_index
+
+    def put(self, docs: List[Document]) -> None:
+        """Save documents to the store."""
+        if self.readonly:
+            raise Exception("Cannot put documents in a readonly store.")
+
+        if len(docs) == 0:
+            return
+
+        self._ensure_loaded()
+
+        for doc in docs:
+            if doc.id in self.id_index:
+                raise ValueError(f"Document {doc.id} already exists.")
+
+            self.id_index[doc.id] = len(self.ids)
+            self.ids.append(doc.id)
+            self.contents.append(doc.content)
+            self.metadatas.append(
+                {k: v for k, v in doc.metadata.items() if v is not None}
+            )
+
+        self.pending_embeddings.append(
+            np.asarray([doc.embedding for doc in docs], dtype=np.float32)
+        )
+
+    def get(self, ids: List[DocId]) -> List[Document]:
+        """Load documents from the store."""
+        self._ensure_loaded()
+        matrix = self._matrix()
+        return [
+            self._doc(self.id_index[id_], matrix)
+            for id_ in ids
+            if id_ in self.id_index
+        ]
+
+    def dump(self) -> List[Document]:
+        """Dump all documents from the store."""
+        self._ensure_loaded()
+        matrix = self._matrix()
+        return [self._doc(i, matrix) for i in range(len(self.ids))]
+
+    def iter_docs(self, batch_size: int) -> Iterator[List[Document]]:
+        """Iterate over all documents of the store in the order of dump,
+        batch_size at a time."""
+        self._ensure_loaded()
+        matrix = self._matrix()
+        for start in range(0, len(self.ids), batch_size):
+            end = min(start + batch_size, len(self.ids))
+            yield [self._doc(i, matrix) for i in range(start, end)]
+
+    def reset(self) -> None:
+        """Reset the document store."""
+        if self.readonly:
+            raise Exception("Cannot reset a readonly store.")
+        self._clear()
+        self.loaded = True
+
+    def load(self) -> None:
+        """Load the document store from disk."""
+        self._clear()
+        self.loaded = True
+
+        docs_path = os.path.join(self.persist_directory, self.DOCS_FILE)
+        if not os.path.exists(docs_path):
+            return
+
+        with open(docs_path) as f:
+            data = json.load(f)
+
+        self.ids = data["ids"]
+        self.contents = data["contents"]
+        self.metadatas = data["metadatas"]
+        self.id_index = {id_: i for i, id_ in enumerate(self.ids)}
+        # a quantized store reads exact embeddings from disk on demand
+        self.embeddings = np.load(
+            os.path.join(self.persist_directory, self.EMBEDDINGS_FILE),
+            mmap_mode=None if self.quantization == "none" else "r",
+        )
+        if self.quantization != "none":
+            self.quantized = QuantizedMatrix(
+                self.embeddings, self.quantization
+            )
+
+    def save(self) -> None:
+        """Save the document store to disk."""
+        if self.readonly:
+            raise Exception("A readonly store cannot be saved.")
+
+        self._ensure_loaded()
+        os.makedirs(self.persist_directory, exist_ok=True)
+
+        np.save(
+            os.path.join(self.persist_directory, self.EMBEDDINGS_FILE),
+            self._matrix(),
+        )
+        data = {
+            "ids": self.ids,
+            "contents": self.contents,
+            "metadatas": self.metadatas,
+        }
+        with open(
+            os.path.join(self.persist_directory, self.DOCS_FILE), "w"
+        ) as f:
+            json.dump(data, f)
+
+    def exists(self) -> bool:
+        """Check if the document store exists."""
+        self._ensure_loaded()
+        return len(self.ids) > 0
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the store in bytes."""
+        if not self.loaded:
+            return 0
+        text_size = sum(len(content) for content in self.contents)
+        matrix = self._matrix()
+        if isinstance(matrix, np.memmap):
+            return self.quantized.nbytes + text_size
+        return matrix.nbytes + text_size
+
+
+class EmbeddingRows:
+    """Embeddings kept as rows of another matrix, in a different order.
+
+    Indexing gathers the rows as float32, so the matrix may be a
+    memory-mapped one."""
+
+    def __init__(self, matrix: Any, rows: np.ndarray):
+        """Select the rows of the matrix."""
+        self.matrix = matrix
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, indices: Any) -> np.ndarray:
+        return np.asarray(
+            self.matrix[self.rows[indices]], dtype=np.float32
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes
+
+
+# chapters are laid out this many bits apart in span keys
+SPAN_CHAPTER_BITS = 32
+
+
+def span_key(chapter: Any, offset: Any) -> Any:
+    """Turn an offset in a chapter into an offset in the whole book, so
+    that spans of every level and chapter compare as plain intervals.
+
+    Works on ints and on int64 arrays, where unknown values are -1."""
+    if isinstance(chapter, np.ndarray):
+        return np.where(
+            (chapter >= 0) & (offset >= 0),
+            (chapter << SPAN_CHAPTER_BITS) + offset,
+            -1,
+        )
+    if chapter is None or offset is None:
+        return None
+    return (chapter << SPAN_CHAPTER_BITS) + offset
+
+
+class DocumentChains:
+    """The documents of a book laid out as arrays by position.
+
+    Documents linked by prev/next ids sit at consecutive positions, so
+    a run of linked documents is a range of positions and extending it
+    only moves the ends of the range."""
+
+    def __init__(
+        self,
+        docs: List[Document],
+        embedding_matrix: Optional[Tuple[Any, Dict[DocId, int]]] = None,
+    ):
+        """Lay out the documents along their links.
+
+        If the store keeps its embeddings in one matrix, the chains
+        refer to its rows rather than copying them."""
+        by_id = {doc.id: doc for doc in docs}
+
+        def linked(a, b):
+            return (
+                a is not None
+                and b is not None
+                and a.metadata.get("next_id") == b.id
+                and b.metadata.get("prev_id") == a.id
+            )
+
+        heads = [
+            doc
+            for doc in docs
+            if not linked(by_id.get(doc.metadata.get("prev_id")), doc)
+        ]
+
+        self.docs: List[Document] = []
+        self.position = {}
+        # docs without a head are on a cycle, start them anywhere
+        for doc in heads + docs:
+            while doc is not None and doc.id not in self.position:
+                self.position[doc.id] = len(self.docs)
+                self.docs.append(doc)
+                next_doc = by_id.get(doc.metadata.get("next_id"))
+                doc = next_doc if linked(doc, next_doc) else None
+
+        self.ids = [doc.id for doc in self.docs]
+        self.contents = [doc.content for doc in self.docs]
+        if embedding_matrix is not None:
+            matrix, row_of_id = embedding_matrix
+            rows = np.array(
+                [row_of_id[id_] for id_ in self.ids], dtype=np.intp
+            )
+            self.embeddings = EmbeddingRows(matrix, rows)
+        elif self.docs:
+            self.embeddings = np.ascontiguousarray(
+                [doc.embedding for doc in self.docs], dtype=np.float32
+            )
+        else:
+            self.embeddings = np.zeros((0, 0), dtype=np.float32)
+
+        self.has_prev = np.array(
+            [False]
+            + [linked(a, b) for a, b in zip(self.docs, self.docs[1:])],
+            dtype=bool,
+        )
+        self.has_next = np.append(self.has_prev[1:], False)
+        self.parent = self._positions("parent_id")
+        # last position of the run sharing the parent of each position
+        self.parent_run_end = np.arange(len(self.docs))
+        for i in range(len(self.docs) - 2, -1, -1):
+            if self.has_next[i] and self.parent[i] == self.parent[i + 1]:
+                self.parent_run_end[i] = self.parent_run_end[i + 1]
+        self.chapter = self._ints("chapter_index")
+        self.start = self._ints("start")
+        self.end = self._ints("end")
+        # spans in offsets of the whole book, -1 if unknown
+        self.span_start = span_key(self.chapter, self.start)
+        self.span_end = span_key(self.chapter, self.end)
+
+    def _positions(self, key: str) -> np.ndarray:
+        return np.array(
+            [
+                self.position.get(doc.metadata.get(key), -1)
+                for doc in self.docs
+            ],
+            dtype=np.intp,
+        )
+
+    def _ints(self, key: str) -> np.ndarray:
+        values = [doc.metadata.get(key) for doc in self.docs]
+        return np.array(
+            [-1 if value is None else value for value in values],
+            dtype=np.int64,
+        )
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the chains in bytes."""
+        text_size = sum(len(content) for content in self.contents)
+        return self.embeddings.nbytes + text_size
+
+
+class NeighborCache:
+    """A resident copy of a book's documents keyed by id.
+
+    Context extension walks the prev/next links of documents one step
+    at a time. The whole book is loaded from the store on first use,
+    after which walking the links never goes back to the store."""
+
+    def __init__(self, doc_store: VectorDocStore):
+        """Create a cache in front of a document store."""
+        self.doc_store = doc_store
+        self.docs = None
+        self.chains = None
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self.docs is not None:
+            return
+
+        with self.lock:
+            if self.docs is None:
+                chains = DocumentChains(
+                    self.doc_store.dump(),
+                    self.doc_store.embedding_matrix(),
+                )
+                if isinstance(chains.embeddings, np.ndarray):
+                    # share the embeddings with the chains' matrix
+                    for doc, embedding in zip(
+                        chains.docs, chains.embeddings
+                    ):
+                        doc.embedding = embedding
+                self.chains = chains
+                self.size_bytes = chains.memory_usage()
+                self.docs = {doc.id: doc for doc in chains.docs}
+
+    def get(self, ids: List[DocId]) -> List[Document]:
+        """Get documents by ids, skipping those that do not exist."""
+        self._ensure_loaded()
+
+        docs = []
+        missing = []
+        for id_ in ids:
+            doc = self.docs.get(id_)
+            if doc is None:
+                missing.append(id_)
+            else:
+                docs.append(doc)
+
+        self.hits += len(ids) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            # the store may have changed since the cache was loaded
+            for doc in self.doc_store.get(missing):
+                self.docs[doc.id] = doc
+                docs.append(doc)
+
+        return docs
+
+    def batch(self, ids: List[DocId]) -> DocumentBatch:
+        """Get a batch of single documents by ids, skipping those that
+        were added to the store since the cache was loaded."""
+        self._ensure_loaded()
+        chains = self.chains
+
+        positions = [chains.position.get(id_) for id_ in ids]
+        positions = np.array(
+            [i for i in positions if i is not None], dtype=np.intp
+        )
+        self.hits += len(positions)
+        self.misses += len(ids) - len(positions)
+
+        return DocumentBatch(
+            chains,
+            positions,
+            positions.copy(),
+            chains.embeddings[positions],
+        )
+
+    def invalidate(self) -> None:
+        """Drop the cached documents, they are reloaded on next use."""
+        with self.lock:
+            self.docs = None
+            self.chains = None
+            self.size_bytes = 0
+
+    def warm_up(self) -> None:
+        """Load the documents now rather than on first use."""
+        self._ensure_loaded()
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the cache in bytes."""
+        return self.size_bytes
+
+    def stats(self) -> dict:
+        """Get the cache hit/miss counters."""
+        return {
+            "size": len(self.docs) if self.docs is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class BookStoreFactory:
     @staticmethod
-    def readonly(book_id, book_dir) -> VectorDocStore:
-        """Get the document store."""
+    def readonly(
+        book_id,
+        book_dir,
+        backend=STORE_BACKEND,
+        quantization=STORE_QUANTIZATION,
+    ) -> VectorDocStore:
+        """Get the document store, the index bundle if there is one."""
+        path = bundle_path(book_dir)
+        if os.path.exists(path):
+            return BundleDocStore.new_local_readonly(path, quantization)
+
+        return BookStoreFactory.backend_readonly(
+            book_id, book_dir, backend, quantization
+        )
+
+    @staticmethod
+    def backend_readonly(
+        book_id,
+        book_dir,
+        backend=STORE_BACKEND,
+        quantization=STORE_QUANTIZATION,
+    ) -> VectorDocStore:
+        """Get the document store of the backend, ignoring any bundle."""
+        if backend == "numpy":
+            store_dir = os.path.join(book_dir, "numpy_store")
+            return NumpyDocStore.new_local_readonly(
+                store_dir, quantization
+            )
+
         collection_name = f"librarian-{book_id}"
         store_dir = os.path.join(book_dir, "store")
         return ChromaDocStore.new_local_readonly(
@@ -184,8 +766,27 @@ class BookStoreFactory:
         )
 
     @staticmethod
-    def mutable(book_id, book_dir) -> VectorDocStore:
+    def mutable(
+        book_id, book_dir, backend=STORE_BACKEND
+    ) -> VectorDocStore:
         """Get the document store."""
+        if backend == "numpy":
+            store_dir = os.path.join(book_dir, "numpy_store")
+            return NumpyDocStore.new_local(store_dir)
+
         collection_name = f"librarian-{book_id}"
         store_dir = os.path.join(book_dir, "store")
         return ChromaDocStore.new_local(collection_name, store_dir)
+
+    @staticmethod
+    def convert_to_bundle(book_id, book_dir, backend=STORE_BACKEND) -> str:
+        """Write the index bundle of a book from its backend store."""
+        store = BookStoreFactory.backend_readonly(
+            book_id, book_dir, backend, quantization="none"
+        )
+        path = bundle_path(book_dir)
+        with BundleWriter(path) as writer:
+            for docs in store.iter_docs(CONVERT_BATCH_SIZE):
+                writer.add(docs)
+            writer.finish()
+        return path
@@ -1,31 +1,531 @@
-import openai
 import numpy as np
+import functools
+import hashlib
+import itertools
+import os
+import re
+import threading
+import random
+import time
+import zlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from .base import Embedding, Embedder
+from .const import (
+    EMBEDDING_CONCURRENCY,
+    LOCAL_EMBEDDING_DIM,
+    LOCAL_EMBEDDING_FEATURES,
+)
 
+# limits of a single embedding request
 CHUNK_SIZE = 500
+CHUNK_TOKENS = 50000
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# the model of a book's local embedder, in the book directory
+LOCAL_EMBEDDER_FILE = "local_embedder.npz"
+LOCAL_TOKEN = re.compile(r"\w+")
+# mixes the hashes of two words into the hash of the bigram
+BIGRAM_MULTIPLIER = np.uint64(0x9E3779B1)
+# extra random directions and power iterations of the randomized SVD
+SVD_OVERSAMPLES = 10
+SVD_POWER_ITERATIONS = 1
+# texts the SVD is fitted on, sampled from bigger books
+SVD_MAX_TEXTS = 4000
+# nonzero entries multiplied at once by the sparse products
+SPARSE_BLOCK_SIZE = 1 << 15
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors():
+    """Get the errors of the embedding API worth retrying."""
+    import openai
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )
 
 
 class OpenAIEmbedder(Embedder):
-    def __init__(self, engine="text-embedding-ada-002"):
+    def __init__(
+        self,
+        engine="text-embedding-ada-002",
+        cache=None,
+        concurrency=EMBEDDING_CONCURRENCY,
+    ):
         self.engine = engine
+        self.cache = cache
+        self.concurrency = concurrency
+
+    @property
+    def name(self):
+        return f"openai:{self.engine}"
 
     def embed_texts(self, texts):
-        """Embeds a list of texts using the OpenAI API."""
-        embeddings = []
-        for i in range(0, len(texts), CHUNK_SIZE):
-            embeddings.extend(
-                self.embed_texts_chunk(texts[i : i + CHUNK_SIZE])
-            )
-        return embeddings
+        """Embeds a list of texts using the OpenAI API.
+
+        Texts found in the embedding cache are not sent to the API, and
+        each distinct text is sent at most once."""
+        unique_texts = list(dict.fromkeys(texts))
+
+        known = {}
+        if self.cache is not None:
+            known = self.cache.get_many(self.name, unique_texts)
+
+        missing = [text for text in unique_texts if text not in known]
+        chunks = self.split_chunks(missing)
+
+        fresh = {}
+        if len(chunks) <= 1 or self.concurrency <= 1:
+            results = map(self.embed_texts_chunk, chunks)
+        else:
+            workers = min(self.concurrency, len(chunks))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # map() yields results in the order of the chunks
+                results = list(
+                    executor.map(self.embed_texts_chunk, chunks)
+                )
+
+        for chunk, embeddings in zip(chunks, results):
+            fresh.update(zip(chunk, embeddings))
+
+        if self.cache is not None:
+            self.cache.put_many(self.name, fresh)
+
+        known.update(fresh)
+        return [known[text] for text in texts]
+
+    def split_chunks(self, texts):
+        """Split texts into requests bounded by size and token count."""
+        chunks = []
+        chunk = []
+        chunk_tokens = 0
+
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if chunk and (
+                len(chunk) >= CHUNK_SIZE
+                or chunk_tokens + tokens > CHUNK_TOKENS
+            ):
+                chunks.append(chunk)
+                chunk = []
+                chunk_tokens = 0
+
+            chunk.append(text)
+            chunk_tokens += tokens
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def count_tokens(self, text):
+        """Count the tokens of a text, or estimate it without tiktoken."""
+        encoding = _tiktoken_encoding(self.engine)
+        if encoding is None:
+            return len(text) // 4 + 1
+
+        return len(encoding.encode(text, disallowed_special=()))
 
     def embed_texts_chunk(self, texts):
-        resp = openai.Embedding.create(input=texts, engine=self.engine)
+        resp = self.create_with_retry(texts)
         data = sorted(resp["data"], key=lambda d: d["index"])
-        return [np.asarray(d["embedding"]) for d in data]
+        return [np.asarray(d["embedding"], dtype=np.float32) for d in data]
+
+    def create_with_retry(self, texts):
+        """Call the embedding API, retrying transient errors."""
+        import openai
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return openai.Embedding.create(
+                    input=texts, engine=self.engine
+                )
+            except retryable_errors() as e:
+                if attempt == MAX_RETRIES:
+                    raise
+
+                # exponential backoff with full jitter
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+                delay = random.uniform(0, delay)
+
+                # respect the server's hint when rate limited
+                retry_after = (e.headers or {}).get("retry-after")
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+
+                print(f"Embedding request failed ({e}), retrying.")
+                time.sleep(delay)
+
+
+class HashEmbedder(Embedder):
+    """A deterministic local embedder for debugging and benchmarks.
+
+    Each word is hashed to a signed dimension and the counts are
+    normalized, so texts sharing words are similar, without any API."""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    @property
+    def name(self):
+        return f"hash:{self.dim}"
+
+    def embed_texts(self, texts):
+        """Embed texts by hashing their words."""
+        return [self.embed_words(text.lower().split()) for text in texts]
+
+    def embed_words(self, words):
+        embedding = np.zeros(self.dim, dtype=np.float32)
+        for word in words:
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            sign = 1.0 if value & 1 else -1.0
+            embedding[(value >> 1) % self.dim] += sign
+
+        norm = np.linalg.norm(embedding)
+        if norm == 0:
+            # texts without words still need a unit vector
+            embedding[0] = 1.0
+            return embedding
+        return embedding / norm
+
+
+class LocalEmbedder(Embedder):
+    """A CPU-only embedder learned from the book it embeds.
+
+    Texts are turned into hashed word and bigram counts, weighted by
+    tf-idf, and projected on the main directions of the book's tf-idf
+    matrix, found by a randomized SVD when the book is indexed. Only
+    the terms found in the book are kept in the projection, with their
+    idf weights folded in, and it is saved in the book directory."""
+
+    per_book = True
+
+    def __init__(
+        self,
+        book_dir=None,
+        dim=LOCAL_EMBEDDING_DIM,
+        n_features=LOCAL_EMBEDDING_FEATURES,
+    ):
+        """Create the embedder of the book in book_dir."""
+        self.book_dir = book_dir
+        self.dim = dim
+        self.n_features = n_features
+        # the row of each hashed term in the projection, -1 if unknown
+        self.rows = None
+        self.projection = None
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"local:tfidf-svd:{self.n_features}:{self.dim}"
+
+    def model_path(self):
+        """Get the path of the fitted model."""
+        return os.path.join(self.book_dir, LOCAL_EMBEDDER_FILE)
+
+    def fitted(self):
+        """Check if the model has been fitted to the book."""
+        return self.projection is not None or (
+            self.book_dir is not None and os.path.exists(self.model_path())
+        )
+
+    def load(self):
+        """Load the fitted model of the book."""
+        with self.lock:
+            if self.projection is not None:
+                return
+            if self.book_dir is None or not os.path.exists(
+                self.model_path()
+            ):
+                raise ValueError(
+                    "The book has no local embedding model, rebuild it."
+                )
+            with np.load(self.model_path()) as model:
+                self.set_model(model["features"], model["projection"])
+
+    def set_model(self, features, projection):
+        """Use the projection of the given hashed terms."""
+        rows = np.full(self.n_features, -1, dtype=np.intp)
+        rows[features] = np.arange(len(features))
+        self.rows = rows
+        self.projection = projection
+
+    def memory_usage(self):
+        """Estimate the memory held by the model in bytes."""
+        if self.projection is None:
+            return 0
+        return self.projection.nbytes + self.rows.nbytes
+
+    def fit(self, texts):
+        """Learn the projection from all texts of the book and save it."""
+        rows, cols, counts = self.count_terms(texts)
+        if len(cols) == 0:
+            raise ValueError("No text to fit the embedder to.")
+        features, cols = np.unique(cols, return_inverse=True)
+        n = len(texts)
+
+        df = np.bincount(cols, minlength=len(features))
+        idf = np.log((1 + n) / (1 + df)).astype(np.float32) + 1
+        values = counts * idf[cols]
+        norms = np.sqrt(
+            np.bincount(rows, weights=values**2, minlength=n)
+        )
+        values /= norms[rows].astype(np.float32)
+
+        # the main directions are found on a sample, idf on all texts
+        sample = _sample_rows(n, SVD_MAX_TEXTS)
+        sampled = np.isin(rows, sample)
+        components = _randomized_svd(
+            sample.searchsorted(rows[sampled]),
+            cols[sampled],
+            values[sampled],
+            (len(sample), len(features)),
+            self.dim,
+        )
+        # books with fewer terms than dimensions leave the rest zero
+        projection = np.zeros((len(features), self.dim), np.float32)
+        projection[:, : len(components)] = components.T
+        projection *= idf[:, None]
+
+        if self.book_dir is not None:
+            tmp_path = self.model_path() + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, features=features, projection=projection)
+            os.replace(tmp_path, self.model_path())
+        self.set_model(features, projection)
+
+    def count_terms(self, texts):
+        """Count the hashed terms of texts as a sparse matrix.
+
+        Returns the rows, columns and sublinear counts of the nonzero
+        entries, sorted by row."""
+        words = [LOCAL_TOKEN.findall(text.lower()) for text in texts]
+        lengths = np.fromiter(map(len, words), np.intp, len(words))
+        hashes = np.fromiter(
+            map(_word_hash, itertools.chain.from_iterable(words)),
+            np.uint64,
+            lengths.sum(),
+        )
+        word_rows = np.repeat(np.arange(len(texts)), lengths)
+
+        # bigrams of consecutive words of the same text
+        same_text = word_rows[1:] == word_rows[:-1]
+        bigrams = (hashes[:-1] * BIGRAM_MULTIPLIER + hashes[1:]) & (
+            np.uint64(0xFFFFFFFF)
+        )
+        terms = np.concatenate([hashes, bigrams[same_text]]) % np.uint64(
+            self.n_features
+        )
+        term_rows = np.concatenate([word_rows, word_rows[1:][same_text]])
+
+        keys, counts = np.unique(
+            term_rows * self.n_features + terms.astype(np.intp),
+            return_counts=True,
+        )
+        counts = 1 + np.log(counts.astype(np.float32))
+        return keys // self.n_features, keys % self.n_features, counts
+
+    def embed_texts(self, texts):
+        """Embed texts by projecting their term counts."""
+        self.load()
+        rows, cols, counts = self.count_terms(texts)
+        cols = self.rows[cols]
+        known = cols >= 0
+        embeddings = _sparse_dot(
+            rows[known],
+            cols[known],
+            counts[known],
+            self.projection,
+            len(texts),
+        )
+        norms = np.linalg.norm(embeddings, axis=1)
+        # texts without known terms still need a unit vector
+        embeddings[norms == 0, 0] = 1
+        norms[norms == 0] = 1
+        embeddings /= norms[:, None]
+        return list(embeddings)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _word_hash(word):
+    # unlike hash(), crc32 is the same in every process
+    return zlib.crc32(word.encode())
+
+
+def _sparse_dot(keys, others, values, dense, n_keys):
+    """Multiply a sparse matrix by a dense one.
+
+    The nonzero entries of the sparse matrix are given by their sorted
+    row keys, columns and values."""
+    result = np.zeros((n_keys, dense.shape[1]), dtype=np.float32)
+    if len(keys) == 0:
+        return result
+
+    run_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    # blocks of about SPARSE_BLOCK_SIZE entries made of whole rows
+    edges = run_starts[
+        np.searchsorted(
+            run_starts,
+            np.arange(0, len(keys), SPARSE_BLOCK_SIZE),
+            side="right",
+        )
+        - 1
+    ]
+    edges = np.unique(np.r_[edges, len(keys)])
+
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        starts = run_starts[
+            np.searchsorted(run_starts, lo) : np.searchsorted(
+                run_starts, hi
+            )
+        ]
+        products = dense[others[lo:hi]]
+        products *= values[lo:hi, None]
+        result[keys[starts]] = np.add.reduceat(products, starts - lo)
+    return result
+
+
+def _sample_rows(n_rows, max_rows, seed=0):
+    """Pick at most max_rows of the rows, sorted, the same every time."""
+    if n_rows <= max_rows:
+        return np.arange(n_rows)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n_rows, max_rows, replace=False))
+
+
+def _randomized_svd(rows, cols, values, shape, rank, seed=0):
+    """Find the top right singular vectors of a sparse matrix.
+
+    Follows Halko et al., with a power iteration since the singular
+    values of text decay slowly."""
+    n_rows, n_cols = shape
+    order = np.argsort(cols, kind="stable")
+    t_rows, t_cols, t_values = cols[order], rows[order], values[order]
+
+    def dot(dense):
+        return _sparse_dot(rows, cols, values, dense, n_rows)
+
+    def t_dot(dense):
+        return _sparse_dot(t_rows, t_cols, t_values, dense, n_cols)
+
+    rng = np.random.default_rng(seed)
+    size = min(rank + SVD_OVERSAMPLES, n_rows, n_cols)
+    q = dot(rng.standard_normal((n_cols, size), dtype=np.float32))
+    # only the short side is orthonormalized between iterations
+    for _ in range(SVD_POWER_ITERATIONS):
+        q, _ = np.linalg.qr(q)
+        q = dot(t_dot(q))
+    q, _ = np.linalg.qr(q)
+
+    # the right singular vectors of the small projection q.T @ X, from
+    # the eigenvectors of its size x size gram matrix
+    b_t = t_dot(q)
+    eigenvalues, eigenvectors = np.linalg.eigh(b_t.T @ b_t)
+    order = np.argsort(eigenvalues)[::-1][:rank]
+    singular_values = np.sqrt(np.maximum(eigenvalues[order], 0))
+    order = order[singular_values > 1e-6 * singular_values.max()]
+    singular_values = singular_values[: len(order)]
+    return (b_t @ eigenvectors[:, order] / singular_values).T
+
+
+class CachedEmbedder(Embedder):
+    """Cache the embeddings of queries in front of another embedder.
+
+    Queries are looked up in an in-memory LRU first, then in the
+    on-disk cache if one is given, and only embedded by the wrapped
+    embedder if both miss. Bulk embedding (i.e. indexing) is passed
+    through as is."""
+
+    def __init__(self, embedder, disk_cache=None, max_entries=1024):
+        """Wrap an embedder with a cache."""
+        self.embedder = embedder
+        self.disk_cache = disk_cache
+        self.max_entries = max_entries
+        self.memory_cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.embedder.name
+
+    def embed_texts(self, texts):
+        """Embed texts with the wrapped embedder."""
+        return self.embedder.embed_texts(texts)
+
+    def embed_text(self, text):
+        """Create an embedding for a single text, using the cache."""
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        """Create embeddings for many questions, using the cache and
+        embedding all the missing ones in one call."""
+        texts = [normalize_query(text) for text in texts]
+
+        found = {}
+        with self.lock:
+            for text in texts:
+                embedding = self.memory_cache.get(text)
+                if embedding is not None:
+                    self.memory_cache.move_to_end(text)
+                    found[text] = embedding
+
+        missing = list(dict.fromkeys(t for t in texts if t not in found))
+        if missing and self.disk_cache is not None:
+            found.update(self.disk_cache.get_many(self.name, missing))
+            missing = [text for text in missing if text not in found]
+
+        if missing:
+            embedded = {
+                text: np.asarray(embedding, dtype=np.float32)
+                for text, embedding in zip(
+                    missing, self.embedder.embed_texts(missing)
+                )
+            }
+            if self.disk_cache is not None:
+                self.disk_cache.put_many(self.name, embedded)
+            found.update(embedded)
+
+        with self.lock:
+            for text in texts:
+                self.memory_cache[text] = found[text]
+                self.memory_cache.move_to_end(text)
+            while len(self.memory_cache) > self.max_entries:
+                self.memory_cache.popitem(last=False)
+
+        return [found[text] for text in texts]
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_encoding(engine):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+
+    # tiktoken downloads the encoding on first use, which may fail
+    try:
+        name = tiktoken.model.MODEL_TO_ENCODING.get(engine, "cl100k_base")
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"Failed to load tiktoken encoding ({e}), estimating.")
+        return None
+
 
-    # Uncomment for debugging
-    #
-    # def embed_texts(self, texts):
-    #     """Embeds a list of texts using the OpenAI API."""
-    #     return [np.random.rand(10) for _ in texts]
+def normalize_query(text):
+    """Normalize a query so trivially different spellings share a key."""
+    return " ".join(text.split())
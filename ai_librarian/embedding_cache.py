@@ -0,0 +1,133 @@
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+from typing import Dict, List
+
+from .base import Embedding
+
+
+class EmbeddingCache:
+    """An on-disk store of embeddings keyed by engine and text.
+
+    Entries are evicted least-recently-used first once the store holds
+    more than max_entries embeddings."""
+
+    def __init__(self, db_path, max_entries):
+        """Open (or create) the cache database at db_path."""
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.create_schema()
+
+    def create_schema(self):
+        """Create the database schema if it does not exist."""
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                engine TEXT NOT NULL,
+                key TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (engine, key)
+            );
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS embeddings_last_used
+            ON embeddings (last_used);
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def key(text: str) -> str:
+        """Get the cache key of a text."""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(
+        self, engine: str, texts: List[str]
+    ) -> Dict[str, Embedding]:
+        """Look up the embeddings of texts, returning those found."""
+        keys = {self.key(text): text for text in texts}
+        found = {}
+
+        with self.lock:
+            key_list = list(keys)
+            # stay below sqlite's limit of bound variables
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = self.conn.execute(
+                    f"""
+                    SELECT key, embedding
+                    FROM embeddings
+                    WHERE engine = ? AND key IN ({placeholders})
+                    """,
+                    (engine, *chunk),
+                )
+                for key, blob in cursor.fetchall():
+                    found[keys[key]] = np.frombuffer(
+                        blob, dtype=np.float32
+                    ).copy()
+
+            if found:
+                self.conn.executemany(
+                    """
+                    UPDATE embeddings
+                    SET last_used = CURRENT_TIMESTAMP
+                    WHERE engine = ? AND key = ?
+                    """,
+                    [(engine, self.key(text)) for text in found],
+                )
+                self.conn.commit()
+
+        return found
+
+    def put_many(self, engine: str, items: Dict[str, Embedding]) -> None:
+        """Store the embeddings of texts."""
+        if not items:
+            return
+
+        rows = [
+            (engine, self.key(text), _to_blob(embedding))
+            for text, embedding in items.items()
+        ]
+
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO embeddings (engine, key, embedding)
+                VALUES (?, ?, ?)
+                """,
+                rows,
+            )
+            self.evict()
+            self.conn.commit()
+
+    def evict(self) -> None:
+        """Remove least recently used entries beyond max_entries."""
+        (count,) = self.conn.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+        if count <= self.max_entries:
+            return
+
+        self.conn.execute(
+            """
+            DELETE FROM embeddings
+            WHERE rowid IN (
+                SELECT rowid FROM embeddings
+                ORDER BY last_used
+                LIMIT ?
+            )
+            """,
+            (count - self.max_entries,),
+        )
+
+
+def _to_blob(embedding: Embedding) -> bytes:
+    return np.asarray(embedding, dtype=np.float32).tobytes()
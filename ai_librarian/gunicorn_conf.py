@@ -0,0 +1,12 @@
+# Gunicorn settings, used with `gunicorn -c python:ai_librarian.gunicorn_conf`
+
+
+def on_starting(server):
+    """Requeue the indexing jobs interrupted by the last shutdown, once
+    for all workers."""
+    from .book_keeper import BookKeeper
+
+    # not the singleton, the workers forked later open their own
+    keeper = BookKeeper()
+    keeper.requeue_interrupted_jobs()
+    keeper.conn.close()
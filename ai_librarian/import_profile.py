@@ -0,0 +1,88 @@
+import builtins
+import importlib.util
+import sys
+import time
+
+# modules listed in the report, slowest first
+REPORT_LIMIT = 25
+
+
+class ImportProfiler:
+    """Time the imports done while installed by wrapping __import__.
+
+    Only the first import of a module is timed. The total time includes
+    the modules it imports in turn, the self time does not."""
+
+    def __init__(self):
+        """Create a profiler, call install to start timing."""
+        self.original_import = None
+        self.started = None
+        self.times = {}
+        # time spent in nested imports of each import in progress
+        self.nested = []
+
+    def install(self):
+        """Start timing imports."""
+        self.original_import = builtins.__import__
+        self.started = time.perf_counter()
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        """Stop timing imports."""
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def _import(
+        self, name, globals=None, locals=None, fromlist=(), level=0
+    ):
+        module = _resolve_name(name, globals, level)
+        if module in sys.modules:
+            return self.original_import(
+                name, globals, locals, fromlist, level
+            )
+
+        self.nested.append(0.0)
+        started = time.perf_counter()
+        try:
+            return self.original_import(
+                name, globals, locals, fromlist, level
+            )
+        finally:
+            total = time.perf_counter() - started
+            nested = self.nested.pop()
+            if self.nested:
+                self.nested[-1] += total
+            self.times[module] = (total, total - nested)
+
+    def report(self, file=sys.stderr):
+        """Print the slowest imports."""
+        self.uninstall()
+        elapsed = time.perf_counter() - self.started
+        imported = sum(own for _, own in self.times.values())
+
+        print(
+            f"\nStartup profile: {len(self.times)} modules imported in "
+            f"{imported * 1000:.0f}ms of {elapsed * 1000:.0f}ms",
+            file=file,
+        )
+        print(f"{'total ms':>9} {'self ms':>9}  module", file=file)
+        slowest = sorted(
+            self.times.items(), key=lambda item: item[1][0], reverse=True
+        )
+        for module, (total, own) in slowest[:REPORT_LIMIT]:
+            print(
+                f"{total * 1000:9.1f} {own * 1000:9.1f}  {module}",
+                file=file,
+            )
+
+
+def _resolve_name(name, globals, level):
+    if level == 0:
+        return name
+
+    package = (globals or {}).get("__package__") or ""
+    try:
+        return importlib.util.resolve_name("." * level + name, package)
+    except ImportError:
+        return name
@@ -1,10 +1,23 @@
 import os
+import json
 import shutil
 
-from .doc_store import ChromaDocStore
+from .doc_store import BookStoreFactory
+from .bundle import BundleWriter, bundle_path
+from .lexical import LexicalIndexBuilder, lexical_index_path
 from .base import Document, Embedding, VectorDocStore
 from .loader import EpubBookLoader
-from .util import get_book_dir, get_embedder
+from .const import STORE_BACKEND
+from .metrics import timed, timed_iter
+from .util import (
+    get_book_dir,
+    get_embedder,
+    read_index_embedder,
+    write_index_embedder,
+)
+
+# number of documents embedded and stored at once
+BATCH_SIZE = 1000
 
 
 class Indexer:
@@ -14,52 +27,196 @@ class Indexer:
         book_dir = get_book_dir(book_id)
         shutil.rmtree(book_dir)
 
-    def __init__(self, book_file):
-        """Create a new indexer."""
+    def __init__(
+        self,
+        book_file,
+        embedder=None,
+        book_dir=None,
+        backend=STORE_BACKEND,
+        answer_cache=None,
+    ):
+        """Create a new indexer.
+
+        The embedder, book directory and backend default to those of the
+        librarian, benchmarks pass their own. The answers about the book
+        in answer_cache, if given, are forgotten when the index is
+        reset."""
         self.book_file = book_file
+        self.answer_cache = answer_cache
 
         self.loader = EpubBookLoader(book_file)
         self.book_id = self.loader.book_id()
 
-        self.book_dir = get_book_dir(self.book_id)
+        self.book_dir = book_dir or get_book_dir(self.book_id)
 
-        self.embedder = get_embedder()
+        self.embedder = embedder or get_embedder(self.book_dir)
 
-        store_dir = os.path.join(self.book_dir, "store")
-        self.doc_store = ChromaDocStore.new_local(
-            f"librarian-{self.book_id}", store_dir
+        self.doc_store = BookStoreFactory.mutable(
+            self.book_id, self.book_dir, backend
         )
 
-    def index(self, force=False):
+    def index(self, force=False, progress=None):
         """Index the book.
 
         If force is True, the book will be re-indexed even if it has
-        already been indexed."""
+        already been indexed. An interrupted indexing resumes from its
+        last checkpoint. If given, progress is called with the number of
+        chapters indexed so far and the total number of chapters."""
 
-        if not force and self.doc_store.exists():
+        if not force and self.indexed():
             return
 
-        self.copy_book_file()
+        with timed("index_copy_book"):
+            self.copy_book_file()
         print("Book file copied.")
 
         self.doc_store.load()
-        self.doc_store.reset()
-        print("Book index reset.")
-
-        self.loader.load()
+        checkpoint = self.load_checkpoint()
+        if (
+            checkpoint is not None
+            and read_index_embedder(self.book_dir) != self.embedder.name
+        ):
+            # the documents stored so far were embedded differently
+            checkpoint = None
+
+        fresh = checkpoint is None
+        if fresh:
+            self.doc_store.reset()
+            self.remove_bundle()
+            self.remove_lexical_index()
+            write_index_embedder(self.book_dir, self.embedder)
+            if self.answer_cache is not None:
+                self.answer_cache.clear(self.book_id)
+            checkpoint = {"chapters_done": 0, "docs_done": 0}
+            self.save_checkpoint(checkpoint)
+            print("Book index reset.")
+        else:
+            print(
+                f"Resuming index from chapter {checkpoint['chapters_done']}."
+            )
+
+        with timed("index_load_book"):
+            self.loader.load()
         print("Book loaded.")
 
-        docs = self.loader.to_docs()
-        print(f"Book fragments generated ({len(docs)}).")
-        if len(docs) == 0:
+        if self.embedder.per_book and (
+            fresh or not self.embedder.fitted()
+        ):
+            with timed("index_fit_embedder"):
+                self.fit_embedder()
+            print("Book embedder fitted.")
+
+        total_chapters = len(self.loader.chapters)
+        if progress is not None:
+            progress(checkpoint["chapters_done"], total_chapters)
+
+        # the docs of the first batch may have been stored before the
+        # checkpoint moved past them, even if no batch was checkpointed
+        resuming = not fresh
+        batch = []
+        chapter_docs = self.loader.iter_chapter_docs(
+            checkpoint["chapters_done"]
+        )
+        for chapter_index, docs in timed_iter("index_split", chapter_docs):
+            batch.extend(docs)
+            if len(batch) < BATCH_SIZE:
+                continue
+
+            self.index_batch(batch, resuming)
+            checkpoint["chapters_done"] = chapter_index + 1
+            checkpoint["docs_done"] += len(batch)
+            self.save_checkpoint(checkpoint)
+            print(f"Book fragments indexed ({checkpoint['docs_done']}).")
+            if progress is not None:
+                progress(checkpoint["chapters_done"], total_chapters)
+            batch = []
+            resuming = False
+
+        if batch:
+            self.index_batch(batch, resuming)
+            checkpoint["docs_done"] += len(batch)
+
+        if checkpoint["docs_done"] == 0:
+            self.remove_checkpoint()
             raise ValueError("No fragments generated. Index failed.")
 
-        self.embedder.embed_docs(docs)
-        print("Embedding generated.")
-
-        self.doc_store.put(docs)
-        self.doc_store.save()
-        print("Book index saved.")
+        with timed("index_save"):
+            self.save_index_files()
+        self.remove_checkpoint()
+        print(f"Book index saved ({checkpoint['docs_done']}).")
+        if progress is not None:
+            progress(total_chapters, total_chapters)
+
+    def index_batch(self, docs, resuming=False):
+        """Embed a batch of documents and save them to the store."""
+        if resuming:
+            # the batch may have been stored right before an interruption
+            stored = self.doc_store.get([doc.id for doc in docs])
+            stored_ids = {doc.id for doc in stored}
+            docs = [doc for doc in docs if doc.id not in stored_ids]
+
+        with timed("index_embed"):
+            self.embedder.embed_docs(docs)
+        with timed("index_store"):
+            self.doc_store.put(docs)
+            self.doc_store.save()
+
+    def fit_embedder(self):
+        """Fit a per-book embedder to all documents of the book."""
+        texts = [
+            doc.content
+            for _, docs in self.loader.iter_chapter_docs()
+            for doc in docs
+        ]
+        self.embedder.fit(texts)
+
+    def checkpoint_path(self):
+        """Get the path of the indexing progress file."""
+        return os.path.join(self.book_dir, "index_progress.json")
+
+    def load_checkpoint(self):
+        """Load the progress of an interrupted indexing, if any."""
+        try:
+            with open(self.checkpoint_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_checkpoint(self, checkpoint):
+        """Persist the indexing progress."""
+        tmp_path = self.checkpoint_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path())
+
+    def remove_checkpoint(self):
+        """Mark the indexing as finished."""
+        if os.path.exists(self.checkpoint_path()):
+            os.remove(self.checkpoint_path())
+
+    def save_index_files(self):
+        """Write the index bundle librarians open the book from and the
+        BM25 index of the words of the book's documents.
+
+        Both are built from the stored documents a batch at a time, so
+        the memory used does not grow with the book."""
+        lexical = LexicalIndexBuilder()
+        with BundleWriter(bundle_path(self.book_dir)) as bundle:
+            for docs in self.doc_store.iter_docs(BATCH_SIZE):
+                bundle.add(docs)
+                lexical.add(docs)
+            bundle.finish()
+        lexical.build().save(lexical_index_path(self.book_dir))
+
+    def remove_bundle(self):
+        """Remove the index bundle, falling back to the store."""
+        if os.path.exists(bundle_path(self.book_dir)):
+            os.remove(bundle_path(self.book_dir))
+
+    def remove_lexical_index(self):
+        """Remove the lexical index, retrieving by embedding only."""
+        if os.path.exists(lexical_index_path(self.book_dir)):
+            os.remove(lexical_index_path(self.book_dir))
 
     def copy_book_file(self):
         """Copy the book file to the book directory."""
@@ -73,4 +230,6 @@ class Indexer:
 
     def indexed(self) -> bool:
         """Check if the book is indexed."""
+        if os.path.exists(self.checkpoint_path()):
+            return False
         return self.doc_store.exists()
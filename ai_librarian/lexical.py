@@ -0,0 +1,292 @@
+import itertools
+import os
+import re
+import threading
+
+import numpy as np
+
+from typing import Any, Dict, List, Optional
+
+from .base import Document, DocId
+from .quantization import top_k
+
+LEXICAL_INDEX_FILE = "lexical_index.npz"
+
+TOKEN = re.compile(r"\w+")
+# the usual BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def lexical_index_path(book_dir: str) -> str:
+    """Get the path of the lexical index of a book."""
+    return os.path.join(book_dir, LEXICAL_INDEX_FILE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a text into lowercase words."""
+    return TOKEN.findall(text.lower())
+
+
+class LexicalIndex:
+    """A BM25 inverted index of the documents of a book.
+
+    The postings of each term are the rows of the documents containing
+    it with their BM25 weight, computed when the index is built, so
+    scoring a query only sums the postings of its terms. An index saved
+    to a file is loaded on first use."""
+
+    def __init__(self, path: Optional[str] = None):
+        """Create an index saved to path, see build for a new one."""
+        self.path = path
+        self.loaded = False
+        self.terms: List[str] = []
+        self.term_index: Dict[str, int] = {}
+        self.ids: List[DocId] = []
+        self.row_index: Optional[Dict[DocId, int]] = None
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int32)
+        self.weights = np.zeros(0, dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def _set(self, terms, ids, indptr, rows, weights):
+        self.terms = terms
+        self.term_index = {term: i for i, term in enumerate(terms)}
+        self.ids = ids
+        self.row_index = None
+        self.indptr = indptr
+        self.rows = rows
+        self.weights = weights
+        self.loaded = True
+
+    @staticmethod
+    def build(docs: List[Document]) -> "LexicalIndex":
+        """Index the words of documents."""
+        builder = LexicalIndexBuilder()
+        builder.add(docs)
+        return builder.build()
+
+    def exists(self) -> bool:
+        """Check if the index has been built."""
+        return self.loaded or (
+            self.path is not None and os.path.exists(self.path)
+        )
+
+    def load(self) -> None:
+        """Load the index from its file."""
+        with self.lock:
+            if self.loaded:
+                return
+            with np.load(self.path) as data:
+                self._set(
+                    _split(data["terms"]),
+                    _split(data["ids"]),
+                    data["indptr"],
+                    data["rows"],
+                    data["weights"],
+                )
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def save(self, path: str) -> None:
+        """Save the index to path, replacing it atomically."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                terms=_join(self.terms),
+                ids=_join(self.ids),
+                indptr=self.indptr,
+                rows=self.rows,
+                weights=self.weights,
+            )
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self.ids)
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the index in bytes."""
+        if not self.loaded:
+            return 0
+        arrays = (
+            self.indptr.nbytes + self.rows.nbytes + self.weights.nbytes
+        )
+        # a rough guess of the size of the strings and the term dict
+        strings = sum(len(term) + 100 for term in self.terms)
+        return arrays + strings + sum(len(id_) + 60 for id_ in self.ids)
+
+    def row_of(self, id_: DocId) -> int:
+        """Get the row of a document, -1 if it is not indexed."""
+        self._ensure_loaded()
+        if self.row_index is None:
+            self.row_index = {id_: i for i, id_ in enumerate(self.ids)}
+        return self.row_index.get(id_, -1)
+
+    def scores(self, query: str) -> np.ndarray:
+        """Score every document against the words of a query."""
+        self._ensure_loaded()
+        term_ids = [
+            self.term_index[word]
+            for word in set(tokenize(query))
+            if word in self.term_index
+        ]
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in term_ids:
+            start, end = self.indptr[term], self.indptr[term + 1]
+            scores[self.rows[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, query: str, k: int) -> List[DocId]:
+        """Find the ids of the k documents scoring best for a query."""
+        return self.top_ids(self.scores(query), k)
+
+    def top_ids(self, scores: np.ndarray, k: int) -> List[DocId]:
+        """Get the ids of the k best positive scores."""
+        return [
+            self.ids[row] for row in top_k(scores, k) if scores[row] > 0
+        ]
+
+    def search_all(self, query: str) -> List[DocId]:
+        """Find the ids of the documents containing all words of a
+        query, the best scoring first."""
+        self._ensure_loaded()
+        words = set(tokenize(query))
+        if not words or not words.issubset(self.term_index):
+            return []
+
+        postings = sorted(
+            (
+                self.rows[self.indptr[term] : self.indptr[term + 1]]
+                for term in map(self.term_index.get, words)
+            ),
+            key=len,
+        )
+        rows = postings[0]
+        for other in postings[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+
+        scores = self.scores(query)[rows]
+        return [
+            self.ids[row]
+            for row in rows[np.argsort(-scores, kind="stable")]
+        ]
+
+
+def contains_phrase(text: str, phrase: str) -> bool:
+    """Check if a text contains the words of a phrase in a row."""
+    words = " ".join(tokenize(phrase))
+    return f" {words} " in f" {' '.join(tokenize(text))} "
+
+
+def quoted_phrase(query: str) -> Optional[str]:
+    """Get the phrase of a query in double quotes, if it is one."""
+    query = query.strip()
+    if len(query) > 2 and query[0] == query[-1] == '"':
+        return query[1:-1]
+    return None
+
+
+def reciprocal_rank_fusion(rankings: List[List[Any]], k: int) -> List[Any]:
+    """Merge rankings by summing 1 / (k + rank) of each item."""
+    scores: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, 1):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank)
+    # sorted() is stable, ties keep the order of the first ranking
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class LexicalIndexBuilder:
+    """Build a LexicalIndex a batch of documents at a time.
+
+    Only the term counts of the documents added are kept, not their
+    texts, and the BM25 weights are computed once all are added."""
+
+    def __init__(self):
+        """Start an empty index."""
+        self.vocabulary: Dict[str, int] = {}
+        self.ids: List[DocId] = []
+        self.lengths: List[np.ndarray] = []
+        # postings of each batch, sorted by term, then by row
+        self.terms: List[np.ndarray] = []
+        self.rows: List[np.ndarray] = []
+        self.tfs: List[np.ndarray] = []
+
+    def add(self, docs: List[Document]) -> None:
+        """Count the words of documents."""
+        words = [tokenize(doc.content) for doc in docs]
+        lengths = np.fromiter(map(len, words), np.intp, len(words))
+
+        vocabulary = self.vocabulary
+        term_ids = np.fromiter(
+            (
+                vocabulary.setdefault(word, len(vocabulary))
+                for word in itertools.chain.from_iterable(words)
+            ),
+            np.intp,
+            lengths.sum(),
+        )
+        word_rows = np.repeat(np.arange(len(docs)), lengths)
+
+        keys, tfs = np.unique(
+            term_ids * len(docs) + word_rows, return_counts=True
+        )
+        terms, rows = np.divmod(keys, max(len(docs), 1))
+
+        self.terms.append(terms)
+        self.rows.append(rows + len(self.ids))
+        self.tfs.append(tfs)
+        self.lengths.append(lengths)
+        self.ids.extend(doc.id for doc in docs)
+
+    def build(self) -> LexicalIndex:
+        """Compute the BM25 weights of the documents added."""
+        empty = [np.zeros(0, dtype=np.intp)]
+        terms = np.concatenate(self.terms or empty)
+        rows = np.concatenate(self.rows or empty)
+        tfs = np.concatenate(self.tfs or empty)
+        lengths = np.concatenate(self.lengths or empty)
+
+        # the rows of a batch follow those of the batches before it, so
+        # a stable sort by term keeps the rows of each term in order
+        order = np.argsort(terms, kind="stable")
+        terms = terms[order]
+        rows = rows[order]
+        tfs = tfs[order]
+
+        n_terms = len(self.vocabulary)
+        df = np.bincount(terms, minlength=n_terms)
+        indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+
+        n = len(self.ids)
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+        avg_length = max(lengths.mean(), 1) if n > 0 else 1
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_length)
+        weights = (
+            idf[terms] * tfs * (BM25_K1 + 1) / (tfs + norms[rows])
+        ).astype(np.float32)
+
+        index = LexicalIndex()
+        index._set(
+            list(self.vocabulary),
+            self.ids,
+            indptr,
+            rows.astype(np.int32),
+            weights,
+        )
+        return index
+
+
+def _join(strings: List[str]) -> np.ndarray:
+    # words and ids never contain newlines
+    return np.frombuffer("\n".join(strings).encode(), dtype=np.uint8)
+
+
+def _split(data: np.ndarray) -> List[str]:
+    text = data.tobytes().decode()
+    return text.split("\n") if text else []
@@ -1,19 +1,23 @@
 import os
 import atexit
+import contextvars
 import subprocess
 import json
 import sys
+import re
 import shutil
 import uuid
+import threading
 
-from langchain.schema import HumanMessage, SystemMessage
-from langchain.chat_models import ChatOpenAI
+from concurrent.futures import ThreadPoolExecutor
 
 from .doc_store import BookStoreFactory
+from .lexical import LexicalIndex, lexical_index_path
 from .loader import EpubBookLoader
 from .retriever import ContextualBookRetriever
-from .const import LIBRARIAN_DIR
-from .util import get_book_dir, get_embedder
+from .const import CHAT_CONCURRENCY, LIBRARIAN_DIR
+from .metrics import timed, timed_iter
+from .util import get_book_dir, get_embedder, check_index_embedder
 
 
 class Librarian:
@@ -25,15 +29,38 @@ class Librarian:
 
         book_dir = get_book_dir(book_id)
 
-        self.embedder = get_embedder()
+        self.embedder = get_embedder(book_dir)
+        check_index_embedder(book_dir, self.embedder)
         self.doc_store = BookStoreFactory.readonly(book_id, book_dir)
 
+        self.lexical = LexicalIndex(lexical_index_path(book_dir))
+
         self.retriever = ContextualBookRetriever(
-            self.embedder, self.doc_store
+            self.embedder, self.doc_store, self.lexical
+        )
+
+    def warm_up(self):
+        """Load everything needed to answer questions ahead of time."""
+        self.doc_store.load()
+        self.embedder.load()
+        if self.lexical.exists():
+            self.lexical.load()
+        self.retriever.neighbors.warm_up()
+        import_chat_modules()
+
+    def memory_usage(self):
+        """Estimate the memory held by the librarian in bytes."""
+        return (
+            self.doc_store.memory_usage()
+            + self.embedder.memory_usage()
+            + self.lexical.memory_usage()
+            + self.retriever.neighbors.memory_usage()
         )
 
     def prompt(self, documents, question):
         """Generate a prompt for the librarian to answer a question."""
+        from langchain.schema import HumanMessage, SystemMessage
+
         if len(documents) == 0:
             raise ValueError("No documents provided.")
 
@@ -78,54 +105,260 @@ class Librarian:
         """Narrow down the documents to a few relevant ones."""
         return self.retriever.retrieve(question, 4)
 
+    def search(self, query, k=10):
+        """Find the documents matching the words of a query, without
+        any API call. A query in double quotes is an exact phrase."""
+        docs = self.retriever.retrieve_lexical(query, k)
+        return [_doc_to_json(doc) for doc in docs]
+
+    def cached_answer(self, question_embedding):
+        """Look up the answer to a similar question asked before."""
+        from .book_keeper import BookKeeper
+
+        keeper = BookKeeper.instance()
+        cached = keeper.answer_cache.lookup(
+            self.book_id, self.embedder.name, question_embedding
+        )
+        if cached is None:
+            return None
+
+        return {
+            "rel_docs": self.retriever.resolve(cached["rel_doc_ids"]),
+            "answer": cached["answer"],
+            "quote": cached["quote"],
+        }
+
+    def cache_answer(self, question, question_embedding, resp):
+        """Remember a successful answer for similar questions."""
+        from .book_keeper import BookKeeper
+
+        if resp.get("error"):
+            return
+
+        BookKeeper.instance().answer_cache.add(
+            self.book_id,
+            self.embedder.name,
+            question,
+            question_embedding,
+            resp["answer"],
+            resp["quote"],
+            _rel_doc_ids(resp["rel_docs"]),
+        )
+
     def chat(self):
         """Get a chatbot."""
-        return ChatOpenAI(temperature=0.5)
+        from langchain.chat_models import ChatOpenAI
 
-    def ask_question_logged(self, question):
-        """Ask the librarian a question and log it."""
-        from .book_keeper import BookKeeper
+        return ChatOpenAI(temperature=0.5)
 
-        resp = self.ask_question_raw(question)
+    def stream_chat(self, prompt):
+        """Stream the chatbot's reply to a prompt piece by piece."""
+        import openai
 
-        answer = resp.get("answer")
-        log_id = str(uuid.uuid4())
-        rel_docs = [
-            {k: v for k, v in doc.dict().items() if k != "embedding"}
-            for doc in resp.get("rel_docs", [])
+        chat = self.chat()
+        messages = [
+            {"role": _message_role(message), "content": message.content}
+            for message in prompt
         ]
 
-        extra = {
-            "error": resp.get("error"),
-            "quote": resp.get("quote"),
-            "rel_docs": rel_docs,
-        }
+        for chunk in openai.ChatCompletion.create(
+            model=chat.model_name,
+            temperature=chat.temperature,
+            messages=messages,
+            stream=True,
+        ):
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                yield content
 
-        keeper = BookKeeper.instance()
-        keeper.add_chat_log(self.book_id, log_id, question, answer, extra)
+    def ask_question_logged(self, question):
+        """Ask the librarian a question and log it."""
+        resp = self.ask_question_raw(question)
+        with timed("log_answer"):
+            return self.log_answer(question, resp)
+
+    def ask_question_stream_logged(self, question):
+        """Ask the librarian a question, streaming the answer, and log it.
+
+        Yields the same events as ask_question_stream, except that the
+        "references" and "done" events carry json-ready rel_docs and the
+        "done" event is the logged answer."""
+        for event in self.ask_question_stream(question):
+            if event["type"] == "references":
+                rel_docs = [_doc_to_json(doc) for doc in event["rel_docs"]]
+                yield {"type": "references", "rel_docs": rel_docs}
+            elif event["type"] == "done":
+                resp = {k: v for k, v in event.items() if k != "type"}
+                with timed("log_answer"):
+                    logged = self.log_answer(question, resp)
+                yield {"type": "done", **logged}
+            else:
+                yield event
+
+    def log_answer(self, question, resp):
+        """Log the answer to a question in the book keeper."""
+        return self.log_answers([question], [resp])[0]
+
+    def log_answers(self, questions, resps):
+        """Log the answers to questions in the book keeper at once."""
+        from .book_keeper import BookKeeper
 
-        return {
-            "question": question,
-            "answer": answer,
-            "log_id": log_id,
-            "book_id": self.book_id,
-            **extra,
-        }
+        logs = []
+        logged = []
+        for question, resp in zip(questions, resps):
+            answer = resp.get("answer")
+            log_id = str(uuid.uuid4())
+            rel_docs = resp.get("rel_docs", [])
+
+            # Only the ids of the references are logged, they are
+            # resolved against the book's store when the history is
+            # listed.
+            extra = {
+                "error": resp.get("error"),
+                "quote": resp.get("quote"),
+                "rel_doc_ids": _rel_doc_ids(rel_docs),
+            }
+            logs.append((log_id, question, answer, extra))
+            logged.append(
+                {
+                    "question": question,
+                    "answer": answer,
+                    "log_id": log_id,
+                    "book_id": self.book_id,
+                    "error": extra["error"],
+                    "quote": extra["quote"],
+                    "rel_docs": [_doc_to_json(doc) for doc in rel_docs],
+                }
+            )
+
+        BookKeeper.instance().add_chat_logs(self.book_id, logs)
+        return logged
 
     def ask_question_raw(self, question):
         """Ask the librarian a question."""
         # Uncomment for debugging
         # return {"rel_docs": [], "answer": "DUMMY", "quote": "DUMMY"}
 
-        documents = self.narrow_down_documents(question)
+        with timed("embed_question"):
+            question_embedding = self.embedder.embed_text(question)
+        with timed("answer_cache_lookup"):
+            cached = self.cached_answer(question_embedding)
+        if cached is not None:
+            return cached
+
+        with timed("retrieve"):
+            documents = self.retriever.retrieve_by_embedding(
+                question_embedding, 4, question
+            )
         prompt = self.prompt(documents, question)
-        resp = self.chat()(prompt).content
+        with timed("chat"):
+            reply = self.chat()(prompt).content
+
+        resp = self.parse_reply(reply, documents)
+        with timed("answer_cache_add"):
+            self.cache_answer(question, question_embedding, resp)
+        return resp
+
+    def ask_many(self, questions):
+        """Ask the librarian many questions and log them.
+
+        The questions are embedded in one call and searched for at
+        once, the chat completions run concurrently, at most
+        CHAT_CONCURRENCY at a time. Returns the logged answers in the
+        order of the questions."""
+        if len(questions) == 0:
+            return []
+
+        with timed("embed_question"):
+            embeddings = self.embedder.embed_queries(questions)
+
+        resps = [None] * len(questions)
+        with timed("answer_cache_lookup"):
+            for i, embedding in enumerate(embeddings):
+                resps[i] = self.cached_answer(embedding)
+        pending = [i for i, resp in enumerate(resps) if resp is None]
+
+        with timed("retrieve"):
+            documents = self.retriever.retrieve_many_by_embedding(
+                [embeddings[i] for i in pending],
+                4,
+                [questions[i] for i in pending],
+            )
 
+        def answer(i, docs):
+            try:
+                prompt = self.prompt(docs, questions[i])
+                with timed("chat"):
+                    reply = self.chat()(prompt).content
+                return self.parse_reply(reply, docs)
+            except Exception as e:
+                # one failed question, e.g. rate limited, does not throw
+                # away the answers to the others
+                return {"error": f"{e.__class__.__name__}: {e}"}
+
+        with ThreadPoolExecutor(max_workers=CHAT_CONCURRENCY) as executor:
+            # each answer runs in a copy of the request's context, so
+            # its stages are timed into the request's trace
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, answer, i, docs
+                )
+                for i, docs in zip(pending, documents)
+            ]
+            for i, future in zip(pending, futures):
+                resp = future.result()
+                resps[i] = resp
+                with timed("answer_cache_add"):
+                    self.cache_answer(questions[i], embeddings[i], resp)
+
+        with timed("log_answer"):
+            return self.log_answers(questions, resps)
+
+    def ask_question_stream(self, question):
+        """Ask the librarian a question, streaming the answer.
+
+        Yields a "references" event with the retrieved documents first,
+        then a "token" event for every piece of the answer as it is
+        generated, and finally a "done" event with the same fields as
+        ask_question_raw returns."""
+        with timed("embed_question"):
+            question_embedding = self.embedder.embed_text(question)
+        with timed("answer_cache_lookup"):
+            cached = self.cached_answer(question_embedding)
+        if cached is not None:
+            yield {"type": "references", "rel_docs": cached["rel_docs"]}
+            yield {"type": "token", "text": cached["answer"]}
+            yield {"type": "done", **cached}
+            return
+
+        with timed("retrieve"):
+            documents = self.retriever.retrieve_by_embedding(
+                question_embedding, 4, question
+            )
+        yield {"type": "references", "rel_docs": documents}
+
+        prompt = self.prompt(documents, question)
+        answer_stream = AnswerStream()
+        reply = []
+        chat_stream = timed_iter("chat", self.stream_chat(prompt))
+        for content in chat_stream:
+            reply.append(content)
+            text = answer_stream.feed(content)
+            if text:
+                yield {"type": "token", "text": text}
+
+        resp = self.parse_reply("".join(reply), documents)
+        with timed("answer_cache_add"):
+            self.cache_answer(question, question_embedding, resp)
+        yield {"type": "done", **resp}
+
+    def parse_reply(self, resp, documents):
+        """Parse the chatbot's json reply to a question."""
         try:
             parsed = json.loads(resp)
         except json.JSONDecodeError:
             print(resp)
-            raise "Invalid response from chatbot."
+            raise ValueError("Invalid response from chatbot.")
 
         if "error" in parsed:
             return {"error": parsed["error"]}
@@ -138,6 +371,116 @@ class Librarian:
         }
 
 
+class AnswerStream:
+    """Extract the answer from the chatbot's json reply as it streams in.
+
+    The reply looks like {"answer": "...", "quote": "..."}. Feeding the
+    reply piece by piece returns the newly decoded part of the answer
+    string, if any."""
+
+    ANSWER_KEY = re.compile(r'"answer"\s*:\s*"')
+
+    def __init__(self):
+        """Start extracting from an empty reply."""
+        self.reply = ""
+        # position of the next undecoded character of the answer
+        self.pos = None
+        self.done = False
+
+    def feed(self, content):
+        """Add a piece of the reply, return the new part of the answer."""
+        self.reply += content
+        if self.done:
+            return ""
+
+        if self.pos is None:
+            match = self.ANSWER_KEY.search(self.reply)
+            if match is None:
+                return ""
+            self.pos = match.end()
+
+        decoded = []
+        while self.pos < len(self.reply):
+            char = self.reply[self.pos]
+            if char == '"':
+                self.done = True
+                break
+
+            if char != "\\":
+                decoded.append(char)
+                self.pos += 1
+                continue
+
+            # wait for the whole escape sequence to arrive
+            length = (
+                6 if self.reply[self.pos + 1 : self.pos + 2] == "u" else 2
+            )
+            escape = self.reply[self.pos : self.pos + length]
+            if len(escape) < length:
+                break
+            try:
+                decoded.append(json.loads(f'"{escape}"'))
+            except json.JSONDecodeError:
+                decoded.append(escape)
+            self.pos += length
+
+        return "".join(decoded)
+
+
+def import_chat_modules():
+    """Import the modules answering a question needs, they are slow to
+    import and only imported on first use otherwise."""
+    import openai
+    import langchain.schema
+    import langchain.chat_models
+
+
+def _message_role(message):
+    from langchain.schema import HumanMessage, SystemMessage
+
+    if isinstance(message, SystemMessage):
+        return "system"
+    if isinstance(message, HumanMessage):
+        return "user"
+    return "assistant"
+
+
+def resolve_rel_docs(book_id, rel_doc_ids_list):
+    """Rebuild json-ready rel_docs from their logged ids, for each list
+    of logged ids.
+
+    The documents are read straight from the book's store, without
+    loading its embedder nor warming a librarian."""
+    from .retriever import concat_docs
+
+    ids = {
+        id_
+        for rel_doc_ids in rel_doc_ids_list
+        for merged_ids in rel_doc_ids
+        for id_ in merged_ids
+    }
+    store = BookStoreFactory.readonly(book_id, get_book_dir(book_id))
+    docs = {doc.id: doc for doc in store.get(list(ids))}
+
+    rel_docs_list = []
+    for rel_doc_ids in rel_doc_ids_list:
+        rel_docs = []
+        for merged_ids in rel_doc_ids:
+            parts = [docs[id_] for id_ in merged_ids if id_ in docs]
+            if len(parts) == len(merged_ids):
+                rel_docs.append(_doc_to_json(concat_docs(parts)))
+        rel_docs_list.append(rel_docs)
+    return rel_docs_list
+
+
+def _rel_doc_ids(docs):
+    return [doc.metadata.get("merged_ids", [doc.id]) for doc in docs]
+
+
+def _doc_to_json(doc):
+    return {k: v for k, v in doc.dict().items() if k != "embedding"}
+
+
 def setup_readline():
     import readline
 
@@ -155,7 +498,11 @@ def setup_readline():
 def interactive(librarian):
     """Ask questions interactively."""
     setup_readline()
-    last_answer = {}
+    last_answer = None
+
+    # load the book while the first question is being typed
+    warm_up = threading.Thread(target=librarian.warm_up, daemon=True)
+    warm_up.start()
 
     while True:
         width = shutil.get_terminal_size().columns
@@ -175,8 +522,8 @@ def interactive(librarian):
 
             for i, rel_doc in enumerate(last_answer["rel_docs"]):
                 print(
-                    # f"\nDocument {i}: {rel_doc.content.strip()[:width-20]}"
-                    f"\nDocument {i}: {rel_doc.content.strip()}"
+                    # f"\nDocument {i}: {rel_doc['content'].strip()[:width-20]}"
+                    f"\nDocument {i}: {rel_doc['content'].strip()}"
                 )
             print("-" * width)
             continue
@@ -184,13 +531,29 @@ def interactive(librarian):
         if question.strip() == "!quit" or question.strip() == "!q":
             break
 
-        resp = librarian.ask_question_logged(question)
+        warm_up.join()
+        resp = None
+        answered = False
+        for event in librarian.ask_question_stream_logged(question):
+            if event["type"] == "token":
+                text = event["text"]
+                if not answered:
+                    text = text.lstrip()
+                    if text == "":
+                        continue
+                    print("Answer: ", end="")
+                    answered = True
+                print(text, end="", flush=True)
+            elif event["type"] == "done":
+                resp = event
+
+        if answered:
+            print()
 
         if resp.get("error"):
             print(f"Error: {resp['error']}")
             continue
 
-        print("Answer: " + resp["answer"].strip())
         if resp["quote"] != "":
             print("\n> " + resp["quote"].strip())
 
@@ -0,0 +1,112 @@
+import threading
+
+from collections import OrderedDict
+
+
+class LibrarianPool:
+    """A process-wide LRU of warm librarians keyed by book id.
+
+    Opening a book's store and loading its documents is paid once per
+    book instead of once per question. The pool is bounded both by the
+    number of librarians and by their estimated memory usage."""
+
+    def __init__(self, max_size, max_memory):
+        """Create a pool of at most max_size librarians and max_memory
+        bytes."""
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.librarians = OrderedDict()
+        self.lock = threading.Lock()
+        # book ids being loaded, to load each book only once at a time
+        self.loading = {}
+        # bumped by invalidate, a load that saw another one is stale
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, book_id):
+        """Get a warm librarian for a book, loading it if needed."""
+        with self.lock:
+            librarian = self.librarians.get(book_id)
+            if librarian is not None:
+                self.librarians.move_to_end(book_id)
+                self.hits += 1
+                return librarian
+
+            self.misses += 1
+            load_lock = self.loading.setdefault(book_id, threading.Lock())
+
+        with load_lock:
+            try:
+                with self.lock:
+                    librarian = self.librarians.get(book_id)
+                    generation = self.generations.get(book_id, 0)
+                if librarian is not None:
+                    return librarian
+
+                librarian = self._load(book_id)
+
+                with self.lock:
+                    # the book changed while it loaded, e.g. while it
+                    # was being re-indexed, so the librarian is not kept
+                    if self.generations.get(book_id, 0) == generation:
+                        self.librarians[book_id] = librarian
+                        self._evict()
+            finally:
+                with self.lock:
+                    self.loading.pop(book_id, None)
+
+        return librarian
+
+    def _load(self, book_id):
+        from .librarian import Librarian
+
+        librarian = Librarian(book_id)
+        librarian.warm_up()
+        return librarian
+
+    def _evict(self):
+        """Drop least recently used librarians beyond the bounds.
+
+        The most recently used librarian is always kept."""
+        while len(self.librarians) > 1:
+            memory = sum(
+                librarian.memory_usage()
+                for librarian in self.librarians.values()
+            )
+            if (
+                len(self.librarians) <= self.max_size
+                and memory <= self.max_memory
+            ):
+                break
+            self.librarians.popitem(last=False)
+
+    def preload(self, book_ids):
+        """Load librarians for the books ahead of their first question."""
+        for book_id in book_ids[: self.max_size]:
+            try:
+                self.get(book_id)
+            except Exception as e:
+                print(f"Failed to preload book {book_id}: {e}")
+
+    def invalidate(self, book_id):
+        """Drop the librarian of a book, e.g. after it changed, and
+        any librarian of it still loading."""
+        with self.lock:
+            self.librarians.pop(book_id, None)
+            self.generations[book_id] = (
+                self.generations.get(book_id, 0) + 1
+            )
+
+    def stats(self):
+        """Get the pool size and hit/miss counters."""
+        with self.lock:
+            return {
+                "size": len(self.librarians),
+                "memory": sum(
+                    librarian.memory_usage()
+                    for librarian in self.librarians.values()
+                ),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
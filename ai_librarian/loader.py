@@ -1,13 +1,18 @@
-import ebooklib
-import ebooklib.epub
-import epub_meta
-from bs4 import BeautifulSoup as BS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from concurrent.futures import ProcessPoolExecutor
 
 from .base import Document, Loader
 
 import pprint
 
+# the levels a book is split into for indexing, from coarse to fine
+INDEX_LEVELS = {
+    "paragraph": {"chunk_size": 800, "chunk_overlap": 0},
+    "sentence": {"chunk_size": 200, "chunk_overlap": 0},
+}
+
+# books with fewer document items than this are parsed in-process
+PARALLEL_PARSE_MIN_ITEMS = 32
+
 
 class EpubBookLoader(Loader):
     epub = None
@@ -17,9 +22,12 @@ class EpubBookLoader(Loader):
     def __init__(self, file_path):
         """Initialize a book loader"""
         self.file_path = file_path
+        self.splitters = {}
 
     def load(self):
         """Parse the book file"""
+        import ebooklib.epub
+
         load_opts = {"ignore_ncx": True}
         self.epub = ebooklib.epub.read_epub(self.file_path, load_opts)
         self.chapters = self._parse_chapters(self.epub)
@@ -39,27 +47,36 @@ class EpubBookLoader(Loader):
 
     def to_docs(self):
         docs = []
-        docs.extend(self.split_paragraph_docs())
-        docs.extend(self.split_sentence_docs())
+        for _, chapter_docs in self.iter_chapter_docs():
+            docs.extend(chapter_docs)
         return docs
 
     def _parse_chapters(self, epub):
         """Parse the chapters of the book"""
-        chapters = []
-        for item in epub.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-            dom = BS(item.get_content(), "xml")
-            title = dom.find("h1") or dom.find("h2") or dom.find("h3")
-            if not title:
-                continue
-            title = title.text
+        import ebooklib
 
-            paragraphs = [p.text for p in dom.find_all("p")]
-            if len(paragraphs) == 0 or len(paragraphs[0]) == 0:
-                continue
+        contents = [
+            item.get_content()
+            for item in epub.get_items_of_type(ebooklib.ITEM_DOCUMENT)
+        ]
 
-            chapter = {"title": title, "paragraphs": paragraphs}
-            chapters.append(chapter)
+        parsed = None
+        if len(contents) >= PARALLEL_PARSE_MIN_ITEMS:
+            try:
+                with ProcessPoolExecutor() as executor:
+                    parsed = list(
+                        executor.map(
+                            _parse_chapter_item, contents, chunksize=4
+                        )
+                    )
+            except OSError as e:
+                # e.g. no semaphore support in the sandbox
+                print(f"Failed to parse in parallel ({e}).")
 
+        if parsed is None:
+            parsed = [_parse_chapter_item(content) for content in contents]
+
+        chapters = [chapter for chapter in parsed if chapter is not None]
         for i in range(len(chapters)):
             chapters[i]["index"] = i
         return chapters
@@ -70,7 +87,7 @@ class EpubBookLoader(Loader):
         for chapter in self.chapters:
             doc = Document(
                 id=f"whole_chapter:{chapter['index']}",
-                content="\n\n".join(chapter["paragraphs"]),
+                content=chapter["content"],
                 metadata={
                     "chapter_index": chapter["index"],
                     "chapter_title": chapter["title"],
@@ -80,37 +97,123 @@ class EpubBookLoader(Loader):
             docs.append(doc)
         return docs
 
-    def _split_docs(self, level, splitter_conf):
-        splitter = RecursiveCharacterTextSplitter(**splitter_conf)
-        docs = []
+    def iter_chapter_docs(self, start=0):
+        """Split the book into documents chapter by chapter.
+
+        Yields (chapter_index, docs) for every chapter from the start-th
+        on. The prev/next links across chapter boundaries are filled in
+        before a chapter is yielded."""
+        last_docs = {}
+        pending = None
+
+        # the chapter before start is split again to link to it
+        for chapter in self.chapters[max(start - 1, 0) :]:
+            chapter_docs = []
+            levels = self._split_chapter_levels(chapter)
+            for level, docs in levels.items():
+                if docs and level in last_docs:
+                    _link(last_docs[level], docs[0])
+                if docs:
+                    last_docs[level] = docs[-1]
+                chapter_docs.extend(docs)
+
+            if pending is not None and pending[0] >= start:
+                yield pending
+            pending = (chapter["index"], chapter_docs)
+
+        if pending is not None and pending[0] >= start:
+            yield pending
+
+    def _split_chapter_levels(self, chapter):
+        """Split a chapter into documents of every index level.
 
-        for whole_doc in self.whole_chapter_docs():
-            chapter_index = whole_doc.metadata["chapter_index"]
-            split_docs = splitter.create_documents([whole_doc.content])
+        Each level is split from the chunks of the coarser level before
+        it, so all levels come from a single pass over the chapter. Every
+        document records its character span in the chapter text as
+        start/end, and documents below the top level record the id of
+        the chunk they were split from as parent_id."""
+        levels = {}
+        # (parent id, text, offset of the text in the chapter)
+        parents = [(None, chapter["content"], 0)]
+
+        for level, conf in INDEX_LEVELS.items():
+            splitter = self._splitter(level, conf)
+            chunks = []
+            links = []
+
+            for parent_id, text, offset in parents:
+                cursor = 0
+                for chunk in splitter.split_text(text):
+                    start = text.find(chunk, cursor)
+                    if start < 0 or offset is None:
+                        span = (None, None)
+                    else:
+                        cursor = start + len(chunk)
+                        span = (offset + start, offset + cursor)
+                    chunks.append(chunk)
+                    links.append((parent_id, span))
+
+            docs = self._chunk_docs(chapter, level, chunks)
+            for doc, (parent_id, (start, end)) in zip(docs, links):
+                doc.metadata["parent_id"] = parent_id
+                doc.metadata["start"] = start
+                doc.metadata["end"] = end
+
+            levels[level] = docs
+            parents = [
+                (doc.id, doc.content, doc.metadata["start"])
+                for doc in docs
+            ]
+
+        return levels
+
+    def _splitter(self, level, splitter_conf):
+        """Get the (cached) text splitter of a level."""
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        if level not in self.splitters:
+            self.splitters[level] = RecursiveCharacterTextSplitter(
+                **splitter_conf
+            )
+        return self.splitters[level]
+
+    def _chunk_docs(self, chapter, level, chunks):
+        """Turn the chunks of a chapter into linked documents."""
+        docs = []
 
-            for part_no, split_doc in enumerate(split_docs):
-                metadata = whole_doc.metadata.copy()
-                metadata["prev_id"] = None
-                metadata["next_id"] = None
+        for part_no, content in enumerate(chunks):
+            metadata = {
+                "chapter_index": chapter["index"],
+                "chapter_title": chapter["title"],
+                "prev_id": None,
+                "next_id": None,
+            }
 
-                part = f"{part_no+1}/{len(split_docs)}"
-                id = f"{level}:{chapter_index}:{part}"
+            part = f"{part_no+1}/{len(chunks)}"
+            id = f"{level}:{chapter['index']}:{part}"
 
-                content = split_doc.page_content
+            doc = Document(
+                id=id,
+                content=content,
+                metadata=metadata,
+                embedding=None,
+            )
+            if docs:
+                _link(docs[-1], doc)
+            docs.append(doc)
 
-                doc = Document(
-                    id=id,
-                    content=content,
-                    metadata=metadata,
-                    embedding=None,
-                )
-                docs.append(doc)
+        return docs
 
-        for i in range(1, len(docs)):
-            docs[i].metadata["prev_id"] = docs[i - 1].id
+    def _split_docs(self, level, splitter_conf):
+        splitter = self._splitter(level, splitter_conf)
+        docs = []
 
-        for i in range(0, len(docs) - 1):
-            docs[i].metadata["next_id"] = docs[i + 1].id
+        for chapter in self.chapters:
+            chunks = splitter.split_text(chapter["content"])
+            chapter_docs = self._chunk_docs(chapter, level, chunks)
+            if docs and chapter_docs:
+                _link(docs[-1], chapter_docs[0])
+            docs.extend(chapter_docs)
 
         return docs
 
@@ -120,14 +223,46 @@ class EpubBookLoader(Loader):
         )
 
     def split_paragraph_docs(self):
-        return self._split_docs(
-            "paragraph", {"chunk_size": 800, "chunk_overlap": 0}
-        )
+        return self._index_level_docs("paragraph")
 
     def split_sentence_docs(self):
-        return self._split_docs(
-            "sentence", {"chunk_size": 200, "chunk_overlap": 0}
-        )
+        return self._index_level_docs("sentence")
+
+    def _index_level_docs(self, level):
+        return [
+            doc
+            for _, docs in self.iter_chapter_docs()
+            for doc in docs
+            if doc.id.startswith(f"{level}:")
+        ]
+
+
+def _parse_chapter_item(content):
+    """Parse the title and paragraphs of a document item.
+
+    Runs in a worker process, so it only takes and returns plain data."""
+    from bs4 import BeautifulSoup as BS
+
+    dom = BS(content, "xml")
+    title = dom.find("h1") or dom.find("h2") or dom.find("h3")
+    if not title:
+        return None
+    title = title.text
+
+    paragraphs = [p.text for p in dom.find_all("p")]
+    if len(paragraphs) == 0 or len(paragraphs[0]) == 0:
+        return None
+
+    return {
+        "title": title,
+        "paragraphs": paragraphs,
+        "content": "\n\n".join(paragraphs),
+    }
+
+
+def _link(prev_doc, next_doc):
+    prev_doc.metadata["next_id"] = next_doc.id
+    next_doc.metadata["prev_id"] = prev_doc.id
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+import time
+
+import numpy as np
+
+from typing import List
+
+QUANTIZATION_MODES = ["none", "float16", "int8"]
+
+# rows converted to float32 at once while scanning a quantized matrix
+SCAN_BLOCK_ROWS = 4096
+# queries scored at once against a matrix, bounding the score matrix
+QUERY_BLOCK_ROWS = 64
+
+
+class QuantizedMatrix:
+    """A lower precision copy of an embedding matrix.
+
+    Scanning it finds a shortlist of candidates which are then
+    re-ranked against the exact float32 rows. int8 rows are scaled by
+    their largest absolute value, so every row keeps its own range."""
+
+    def __init__(self, matrix: np.ndarray, mode: str):
+        """Quantize a float32 matrix, which may be memory-mapped."""
+        if mode not in ("float16", "int8"):
+            raise ValueError(f"Unknown quantization mode {mode}.")
+
+        self.mode = mode
+        dtype = np.float16 if mode == "float16" else np.int8
+        self.values = np.empty(matrix.shape, dtype=dtype)
+        self.scales = None
+        if mode == "int8":
+            self.scales = np.ones(len(matrix), dtype=np.float32)
+
+        for start in range(0, len(matrix), SCAN_BLOCK_ROWS):
+            end = start + SCAN_BLOCK_ROWS
+            block = np.asarray(matrix[start:end], dtype=np.float32)
+            if mode == "float16":
+                self.values[start:end] = block
+                continue
+
+            scales = np.abs(block).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self.scales[start:end] = scales
+            self.values[start:end] = np.rint(block / scales[:, None])
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def nbytes(self) -> int:
+        scales_size = self.scales.nbytes if self.scales is not None else 0
+        return self.values.nbytes + scales_size
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        """Approximate the dot products of the rows with a query."""
+        scores = np.empty(len(self.values), dtype=np.float32)
+        for start in range(0, len(self.values), SCAN_BLOCK_ROWS):
+            end = start + SCAN_BLOCK_ROWS
+            block = self.values[start:end].astype(np.float32)
+            scores[start:end] = block @ query
+
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Get the indices of the k highest scores, highest first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+
+    # argpartition finds the top k in O(n), only those get sorted
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def top_k_many(
+    matrix: np.ndarray, queries: np.ndarray, k: int
+) -> List[np.ndarray]:
+    """Get the indices of the k rows most similar to each query, scoring
+    a block of queries with one matrix product."""
+    results = []
+    for start in range(0, len(queries), QUERY_BLOCK_ROWS):
+        scores = queries[start : start + QUERY_BLOCK_ROWS] @ matrix.T
+        results.extend(top_k(row, k) for row in scores)
+    return results
+
+
+def reranked_top_k(
+    quantized: QuantizedMatrix,
+    matrix: np.ndarray,
+    query: np.ndarray,
+    k: int,
+    shortlist: int,
+) -> np.ndarray:
+    """Get the indices of the k rows most similar to the query.
+
+    The quantized matrix is scanned for a shortlist, whose exact rows
+    decide the final order."""
+    candidates = np.sort(top_k(quantized.scores(query), max(k, shortlist)))
+    exact_scores = np.asarray(matrix[candidates], dtype=np.float32) @ query
+    return candidates[top_k(exact_scores, k)]
+
+
+def recall_report(
+    matrix: np.ndarray,
+    mode: str,
+    k: int = 10,
+    rerank_factor: int = 4,
+    n_queries: int = 200,
+    seed: int = 0,
+) -> dict:
+    """Measure how well quantized search finds the exact top k.
+
+    Some of the book's own embeddings are used as queries and held out
+    of the searched rows, otherwise each query would find itself first
+    whatever the quantization. Recall is reported for the quantized scan
+    alone and after the exact re-rank."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    held_out = rng.choice(
+        len(matrix), min(n_queries, len(matrix) // 2), replace=False
+    )
+    queries = matrix[held_out]
+    matrix = np.delete(matrix, held_out, axis=0)
+
+    started = time.perf_counter()
+    quantized = QuantizedMatrix(matrix, mode)
+    quantize_time = time.perf_counter() - started
+
+    exact_time = scan_time = rerank_time = 0.0
+    scan_hits = rerank_hits = 0
+    for query in queries:
+        started = time.perf_counter()
+        exact = set(top_k(matrix @ query, k))
+        exact_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        scanned = top_k(quantized.scores(query), k)
+        scan_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        reranked = reranked_top_k(
+            quantized, matrix, query, k, k * rerank_factor
+        )
+        rerank_time += time.perf_counter() - started
+
+        scan_hits += len(exact.intersection(scanned))
+        rerank_hits += len(exact.intersection(reranked))
+
+    n = max(len(queries), 1)
+    expected = n * min(k, len(matrix))
+    return {
+        "mode": mode,
+        "k": k,
+        "rerank_factor": rerank_factor,
+        "queries": len(queries),
+        "recall": scan_hits / max(expected, 1),
+        "recall_reranked": rerank_hits / max(expected, 1),
+        "exact_bytes": matrix.nbytes,
+        "quantized_bytes": quantized.nbytes,
+        "quantize_ms": quantize_time * 1000,
+        "exact_query_ms": exact_time * 1000 / n,
+        "quantized_query_ms": scan_time * 1000 / n,
+        "reranked_query_ms": rerank_time * 1000 / n,
+    }
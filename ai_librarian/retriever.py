@@ -1,87 +1,347 @@
-import langchain
+import bisect
+import contextvars
+import os
+
 import numpy as np
 
 from typing import List
-from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
 
-from .base import Retriever, Embedding, Document, DocId
+from .base import Retriever, Document, DocumentBatch, DocId
+from .const import LEXICAL_FUSION_K, MMR_LAMBDA
+from .doc_store import NeighborCache, span_key
+from .lexical import contains_phrase, quoted_phrase, reciprocal_rank_fusion
+from .metrics import timed
 
 
 class ContextualBookRetriever(Retriever):
     """Retrieve the most relevant context for docs."""
 
-    def __init__(self, embedder, doc_store):
-        """Initialize the retriever."""
+    def __init__(
+        self,
+        embedder,
+        doc_store,
+        lexical=None,
+        fusion_k=LEXICAL_FUSION_K,
+        mmr_lambda=MMR_LAMBDA,
+    ):
+        """Initialize the retriever.
+
+        If given a LexicalIndex, questions are also searched by their
+        words and both rankings are fused."""
         self.doc_store = doc_store
         self.embedder = embedder
+        self.mmr_lambda = mmr_lambda
+        self.neighbors = NeighborCache(doc_store)
+        self.lexical = lexical
+        self.fusion_k = fusion_k
+        # the lexical index row of each position of the chains
+        self.lexical_rows = (None, None)
 
     def retrieve(self, query, k):
         """Retrieve the most relevant context for docs."""
-        query_embedding = self.embedder.embed_text(query)
+        with timed("embed_query"):
+            query_embedding = self.embedder.embed_text(query)
+        return self.retrieve_by_embedding(query_embedding, k, query)
+
+    def use_lexical(self):
+        """Check if questions are searched by their words too."""
+        return (
+            self.lexical is not None
+            and self.fusion_k > 0
+            and self.lexical.exists()
+        )
 
-        relevant_docs = self.doc_store.query_by_embedding(
-            query_embedding, k * 5
+    def retrieve_by_embedding(self, query_embedding, k, query=None):
+        """Retrieve the most relevant context for an embedded query.
+
+        The candidates are kept in a DocumentBatch throughout, only the
+        k documents returned are built. If the query itself is given,
+        the best BM25 matches of its words join the candidates and the
+        final order fuses both rankings."""
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        with timed("store_query"):
+            ids = self.doc_store.query_ids_by_embedding(
+                query_embedding, k * 5
+            )
+        with timed("load_neighbors"):
+            batch = self.neighbors.batch(ids)
+
+        # diversify a little
+        with timed("mmr"):
+            if len(batch) > 0:
+                batch = batch.take(
+                    mmr(
+                        query_embedding,
+                        batch.embeddings,
+                        k * 2,
+                        self.mmr_lambda,
+                    )
+                )
+
+        return self.retrieve_from_candidates(
+            query_embedding, batch, k, query
         )
 
+    def retrieve_many_by_embedding(
+        self, query_embeddings, k, queries=None
+    ):
+        """Retrieve the most relevant context for many embedded queries.
+
+        The store is searched for all queries with one matrix product
+        and MMR picks the candidates of all of them at once. The rest
+        runs for each query in a pool of threads."""
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if len(query_embeddings) == 0:
+            return []
+        if queries is None:
+            queries = [None] * len(query_embeddings)
+
+        with timed("store_query"):
+            ids_list = self.doc_store.query_ids_by_embeddings(
+                query_embeddings, k * 5
+            )
+        with timed("load_neighbors"):
+            batches = [self.neighbors.batch(ids) for ids in ids_list]
+
         # diversify a little
-        relevant_docs = _mmr(self, query_embedding, relevant_docs, k * 2)
+        with timed("mmr"):
+            picks = mmr_batch(
+                query_embeddings,
+                [batch.embeddings for batch in batches],
+                k * 2,
+                self.mmr_lambda,
+            )
+            batches = [
+                batch.take(picked) for batch, picked in zip(batches, picks)
+            ]
+
+        workers = min(len(batches), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # in copies of the caller's context, to time into its trace
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    self.retrieve_from_candidates,
+                    query_embedding,
+                    batch,
+                    k,
+                    query,
+                )
+                for query_embedding, batch, query in zip(
+                    query_embeddings, batches, queries
+                )
+            ]
+            return [future.result() for future in futures]
+
+    def retrieve_from_candidates(self, query_embedding, batch, k, query):
+        """Extend the candidates picked for a query into its k most
+        relevant documents."""
+        lexical_scores = None
+        if query is not None and self.use_lexical():
+            with timed("lexical_query"):
+                lexical_scores = self.lexical.scores(query)
+                lexical_ids = self.lexical.top_ids(lexical_scores, k)
+            # word matches the embedding search missed
+            chains = self.neighbors.chains
+            ids = [chains.ids[i] for i in batch.starts]
+            ids += [id_ for id_ in lexical_ids if id_ not in ids]
+            batch = self.neighbors.batch(ids)
+
+        if len(batch) == 0:
+            return []
 
         # try extend the context as needed
-        relevant_docs = [
-            self.extend_context(query_embedding, doc)
-            for doc in relevant_docs
-        ]
+        with timed("extend_context"):
+            batch = self.extend_context_batch(query_embedding, batch)
 
         # remove subdocs
-        relevant_docs = remove_subdocs(relevant_docs)
+        with timed("remove_subdocs"):
+            batch = batch.take(remove_subdocs_batch(batch))
 
         # reorder based on the length, similarity, etc.
-        relevant_docs = self.reorder_docs(query_embedding, relevant_docs)
-
-        return relevant_docs[:k]
-
-    def reorder_docs(self, query_embedding, docs):
-        """Reorder the docs based on the length, similarity, etc."""
-
-        def dist(doc):
-            return cosine_dist(query_embedding, doc.embedding)
-
-        return sorted(docs, key=dist)
-
-    def extend_context(self, query_embedding, doc):
-        """Extend the context of a document until it is no longer possible."""
-        new_best_doc = self.extend_context_step(query_embedding, doc)
-
-        if new_best_doc.id == doc.id:
-            return doc
+        with timed("reorder"):
+            if lexical_scores is None:
+                order = self.reorder_batch(query_embedding, batch)
+            else:
+                order = self.reorder_fused(
+                    query_embedding, batch, lexical_scores
+                )
+            batch = batch.take(order[:k])
+
+        with timed("build_docs"):
+            return self.to_docs(batch)
+
+    def retrieve_lexical(self, query, k):
+        """Retrieve documents by the words of a query alone, without
+        embedding it.
+
+        A query in double quotes only matches documents containing it
+        as a phrase. Documents containing or contained in a better match
+        are left out, so a sentence does not come with its paragraph."""
+        if self.lexical is None or not self.lexical.exists():
+            raise ValueError("The book has no lexical index, rebuild it.")
+
+        phrase = quoted_phrase(query)
+        with timed("lexical_query"):
+            if phrase is None:
+                ids = self.lexical.search(query, k * 5)
+            else:
+                ids = self.lexical.search_all(phrase)
+
+        # one at a time, as documents missing from the cache come last
+        docs = [doc for id_ in ids for doc in self.neighbors.get([id_])]
+        if phrase is not None:
+            docs = [
+                doc for doc in docs if contains_phrase(doc.content, phrase)
+            ]
+
+        kept = _remove_contained(
+            [_span(doc) for doc in docs],
+            lambda a, b: contains(docs[a], docs[b]),
+            both_ways=True,
+        )
+        return [docs[i] for i in kept[:k]]
+
+    def to_docs(self, batch: DocumentBatch) -> List[Document]:
+        """Build the documents of a batch."""
+        docs = []
+        for i in range(len(batch)):
+            parts = batch.chains.docs[batch.starts[i] : batch.ends[i] + 1]
+            if len(parts) == 1:
+                docs.append(parts[0])
+                continue
+            doc = concat_docs(parts)
+            # the order the run was extended in weighs its embedding
+            doc.embedding = batch.embeddings[i]
+            docs.append(doc)
+        return docs
 
-        return self.extend_context(query_embedding, new_best_doc)
+    def resolve(self, merged_ids_list):
+        """Rebuild retrieved documents from the ids merged into each."""
+        docs = []
+        for merged_ids in merged_ids_list:
+            parts = self.neighbors.get(merged_ids)
+            if len(parts) == len(merged_ids):
+                docs.append(concat_docs(parts))
+        return docs
 
-    def extend_context_step(self, query_embedding, doc):
-        """Extend the context of a document by one step."""
-        docs = [doc]
-        if doc.metadata.get("prev_id"):
-            prev_doc = self.doc_store.get([doc.metadata["prev_id"]])[0]
-            docs.append(concat_doc(prev_doc, doc))
-        if doc.metadata.get("next_id"):
-            next_doc = self.doc_store.get([doc.metadata["next_id"]])[0]
-            docs.append(concat_doc(doc, next_doc))
+    def reorder_batch(self, query_embedding, batch):
+        """Order the rows of a batch by their distance to the query."""
+        dists = 1 - batch.embeddings @ query_embedding
+        return np.argsort(dists, kind="stable")
+
+    def reorder_fused(self, query_embedding, batch, lexical_scores):
+        """Order the rows of a batch by the reciprocal rank fusion of
+        their similarity and of the BM25 score of their words."""
+        by_similarity = self.reorder_batch(query_embedding, batch)
+
+        # a run scores as its best matching document
+        rows = self.chains_lexical_rows(batch.chains)
+        position_scores = np.where(rows >= 0, lexical_scores[rows], 0)
+        run_scores = np.array(
+            [
+                position_scores[start : end + 1].max()
+                for start, end in zip(batch.starts, batch.ends)
+            ]
+        )
+        by_words = np.argsort(-run_scores, kind="stable")
+        by_words = by_words[run_scores[by_words] > 0]
 
-        best_doc = min(
-            docs,
-            key=lambda doc: cosine_dist(query_embedding, doc.embedding),
+        fused = reciprocal_rank_fusion(
+            [by_similarity.tolist(), by_words.tolist()], self.fusion_k
         )
-        return best_doc
+        return np.array(fused, dtype=np.intp)
+
+    def chains_lexical_rows(self, chains):
+        """Map the positions of the chains to lexical index rows."""
+        cached_chains, rows = self.lexical_rows
+        if cached_chains is not chains:
+            rows = np.array(
+                [self.lexical.row_of(id_) for id_ in chains.ids],
+                dtype=np.intp,
+            )
+            self.lexical_rows = (chains, rows)
+        return rows
+
+    def extend_context_batch(self, query_embedding, batch):
+        """Extend the context of all rows of a batch at once.
+
+        At each step a row grows to its previous or next neighbor or
+        jumps to its parent, whichever is closest to the query, and stops
+        once none of them is closer than the row itself. The rows that
+        stopped extending drop out of the next step."""
+        chains = batch.chains
+        starts = batch.starts.copy()
+        ends = batch.ends.copy()
+        embeddings = batch.embeddings.copy()
+
+        active = np.arange(len(batch))
+        while len(active) > 0:
+            s = starts[active]
+            e = ends[active]
+            current = embeddings[active]
+
+            has_prev = chains.has_prev[s]
+            has_next = chains.has_next[e]
+            prev_emb = _normalize(
+                chains.embeddings[s - has_prev] + current
+            )
+            next_emb = _normalize(
+                current + chains.embeddings[e + has_next]
+            )
+            # a run has a parent only if all its documents share it
+            parent = chains.parent[s]
+            has_parent = (parent >= 0) & (chains.parent_run_end[s] >= e)
+            parent_emb = chains.embeddings[np.where(has_parent, parent, s)]
+
+            # the current run first, so ties keep the row as it is
+            dists = 1 - np.stack(
+                [
+                    current @ query_embedding,
+                    prev_emb @ query_embedding,
+                    next_emb @ query_embedding,
+                    parent_emb @ query_embedding,
+                ]
+            )
+            dists[1, ~has_prev] = np.inf
+            dists[2, ~has_next] = np.inf
+            dists[3, ~has_parent] = np.inf
+            best = np.argmin(dists, axis=0)
+
+            to_prev = best == 1
+            starts[active[to_prev]] -= 1
+            embeddings[active[to_prev]] = prev_emb[to_prev]
+            to_next = best == 2
+            ends[active[to_next]] += 1
+            embeddings[active[to_next]] = next_emb[to_next]
+            to_parent = best == 3
+            starts[active[to_parent]] = parent[to_parent]
+            ends[active[to_parent]] = parent[to_parent]
+            embeddings[active[to_parent]] = parent_emb[to_parent]
+
+            active = active[best != 0]
+
+        return DocumentBatch(chains, starts, ends, embeddings)
 
 
 def contains(a: Document, b: Document) -> bool:
     """Check if a contains b."""
+    # spans are offsets in the book across all levels
+    a_span = _span(a)
+    b_span = _span(b)
+    if a_span is not None and b_span is not None:
+        return a_span[0] <= b_span[0] and b_span[1] <= a_span[1]
+
     a_merged_ids = set(a.metadata.get("merged_ids", [a.id]))
     b_merged_ids = set(b.metadata.get("merged_ids", [b.id]))
 
     if a_merged_ids >= b_merged_ids:
         return True
 
+    if b.metadata.get("parent_id") in a_merged_ids:
+        return True
+
     # it can happen when sentence/paragraph contains the same text
     if b.content.replace(" ", "") in a.content.replace(" ", ""):
         return True
@@ -89,16 +349,101 @@ def contains(a: Document, b: Document) -> bool:
     return False
 
 
-def remove_subdocs(docs: List[Document]) -> List[Document]:
-    """Detect documents contained in other documents and remove them."""
-    if len(docs) <= 1:
-        return docs
+def _span(doc: Document):
+    """Get the (start, end) span keys of a document if known."""
+    chapter = doc.metadata.get("chapter_index")
+    start = span_key(chapter, doc.metadata.get("start"))
+    end = span_key(chapter, doc.metadata.get("end"))
+    return None if start is None or end is None else (start, end)
+
+
+class SpanSet:
+    """The union of spans, kept as the sorted spans not contained in
+    others, so that checking if it covers a span is a binary search."""
+
+    def __init__(self):
+        """Create an empty set."""
+        # with no span containing another, the ends are sorted too
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+    def covers(self, start: int, end: int) -> bool:
+        """Check if a single span of the set contains a span."""
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def within(self, start: int, end: int) -> bool:
+        """Check if a span contains a span of the set."""
+        # the first span starting in it is the one ending first
+        i = bisect.bisect_left(self.starts, start)
+        return i < len(self.starts) and self.ends[i] <= end
+
+    def add(self, start: int, end: int) -> None:
+        """Add a span, dropping the spans it contains."""
+        if self.covers(start, end):
+            return
+        i = bisect.bisect_left(self.starts, start)
+        j = i
+        while j < len(self.ends) and self.ends[j] <= end:
+            j += 1
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+
+def _remove_contained(spans, contains, both_ways=False) -> List[int]:
+    """Find the indices of the spans not contained in an earlier kept
+    one, in O(n log n). With both_ways, the spans containing an earlier
+    kept one are left out too. contains(a, b) settles the pairs where a
+    span is unknown, i.e. None."""
+
+    def related(a, b):
+        return contains(a, b) or (both_ways and contains(b, a))
+
+    covered = SpanSet()
+    kept = []
+    kept_unknown = []
+    for i, span in enumerate(spans):
+        if span is None:
+            if any(related(j, i) for j in kept):
+                continue
+            kept_unknown.append(i)
+        else:
+            if (
+                covered.covers(*span)
+                or (both_ways and covered.within(*span))
+                or any(related(j, i) for j in kept_unknown)
+            ):
+                continue
+            covered.add(*span)
+        kept.append(i)
+    return kept
+
+
+def remove_subdocs_batch(batch: DocumentBatch) -> List[int]:
+    """Find the rows of a batch not contained in earlier rows."""
+    chains = batch.chains
+    starts = batch.starts
+    ends = batch.ends
+    parents = np.where(
+        chains.parent_run_end[starts] >= ends, chains.parent[starts], -1
+    )
+    span_starts, span_ends = batch.spans()
+    spans = [
+        None if start < 0 else (start, end)
+        for start, end in zip(span_starts.tolist(), span_ends.tolist())
+    ]
+
+    def contains_row(a, b):
+        if starts[a] <= starts[b] and ends[b] <= ends[a]:
+            return True
+
+        if parents[b] >= 0 and starts[a] <= parents[b] <= ends[a]:
+            return True
+
+        a_content = batch.content(a).replace(" ", "")
+        return batch.content(b).replace(" ", "") in a_content
 
-    new_docs = [docs[0]]
-    for doc in docs[1:]:
-        if not any(contains(new_doc, doc) for new_doc in new_docs):
-            new_docs.append(doc)
-    return new_docs
+    return _remove_contained(spans, contains_row)
 
 
 def calc_doc_id(doc: Document) -> DocId:
@@ -142,6 +487,15 @@ def concat_doc(a: Document, b: Document) -> Document:
 
     metadata["merged_ids"] = a_merged_ids + b_merged_ids
 
+    if a.metadata.get("parent_id") != b.metadata.get("parent_id"):
+        metadata["parent_id"] = None
+
+    if a.metadata.get("chapter_index") == b.metadata.get("chapter_index"):
+        metadata["end"] = b.metadata.get("end")
+    else:
+        metadata["start"] = None
+        metadata["end"] = None
+
     embedding = a.embedding + b.embedding
     embedding_normalized = embedding / np.linalg.norm(embedding)
 
@@ -164,16 +518,70 @@ def concat_docs(docs: List[Document]) -> Document:
     return doc
 
 
-def cosine_dist(a: Embedding, b: Embedding):
-    """Cosine distance between two vectors. Assuming both normalized."""
-    return 1 - np.dot(a, b)
-
-
-def _mmr(self, query_embedding, docs, k):
-    embedding_list = [doc.embedding for doc in docs]
-    selected_indices = (
-        langchain.vectorstores.utils.maximal_marginal_relevance(
-            query_embedding, embedding_list, 0.5, k
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def mmr(query_embedding, embeddings, k, lambda_mult=MMR_LAMBDA):
+    """Pick k embeddings by maximal marginal relevance to a query, most
+    relevant first, and get their indices."""
+    return mmr_batch(
+        np.asarray(query_embedding)[None], [embeddings], k, lambda_mult
+    )[0]
+
+
+def mmr_batch(
+    query_embeddings, embeddings_list, k, lambda_mult=MMR_LAMBDA
+):
+    """Pick k embeddings by maximal marginal relevance for each query,
+    from the candidate embeddings of each query.
+
+    All similarities are computed once up front. Each round then only
+    updates the maximum similarity of every candidate to the picked
+    ones, for all queries at once."""
+    n_queries = len(embeddings_list)
+    sizes = np.array([len(e) for e in embeddings_list], dtype=np.intp)
+    n = int(sizes.max()) if n_queries else 0
+    if n == 0 or k <= 0:
+        return [[] for _ in range(n_queries)]
+
+    # pad the candidates of every query to n rows
+    dim = np.shape(query_embeddings)[1]
+    candidates = np.zeros((n_queries, n, dim), dtype=np.float32)
+    for i, embeddings in enumerate(embeddings_list):
+        if sizes[i] > 0:
+            candidates[i, : sizes[i]] = embeddings
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+
+    # cosine similarities, 0 against zero vectors and padding
+    norms = np.linalg.norm(candidates, axis=2)
+    norms[norms == 0] = np.inf
+    query_norms = np.linalg.norm(queries, axis=1)
+    query_norms[query_norms == 0] = np.inf
+    to_query = np.einsum("qnd,qd->qn", candidates, queries)
+    to_query /= norms * query_norms[:, None]
+    to_each_other = np.matmul(candidates, candidates.transpose(0, 2, 1))
+    to_each_other /= norms[:, :, None] * norms[:, None, :]
+
+    available = np.arange(n)[None, :] < sizes[:, None]
+    counts = np.minimum(sizes, k)
+    rows = np.arange(n_queries)
+    picked = np.zeros((n_queries, int(counts.max())), dtype=np.intp)
+
+    # the first pick is the most relevant one
+    scores = np.where(available, to_query, -np.inf)
+    max_similarity = np.full((n_queries, n), -np.inf, dtype=np.float32)
+    for round_ in range(picked.shape[1]):
+        best = np.argmax(scores, axis=1)
+        picked[:, round_] = best
+        available[rows, best] = False
+        np.maximum(
+            max_similarity, to_each_other[rows, best], out=max_similarity
         )
-    )
-    return [docs[i] for i in selected_indices]
+        scores = np.where(
+            available,
+            lambda_mult * to_query - (1 - lambda_mult) * max_similarity,
+            -np.inf,
+        )
+
+    return [picked[i, :count].tolist() for i, count in enumerate(counts)]
@@ -1,8 +1,21 @@
 import os
+import json
+import functools
 
-from .const import LIBRARIAN_DIR
+from .const import (
+    LIBRARIAN_DIR,
+    EMBEDDER,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    QUERY_CACHE_MAX_ENTRIES,
+)
 from .base import Embedder
-from .embedder import OpenAIEmbedder
+from .embedder import OpenAIEmbedder, CachedEmbedder, LocalEmbedder
+from .embedding_cache import EmbeddingCache
+
+# the name of the embedder a book was indexed with, in its directory
+EMBEDDER_FILE = "embedder.json"
+# books indexed before the embedder was recorded used this one
+LEGACY_EMBEDDER = "openai:text-embedding-ada-002"
 
 
 def get_book_dir(book_id: str) -> str:
@@ -11,6 +24,53 @@ def get_book_dir(book_id: str) -> str:
     return os.path.join(book_dir, book_id)
 
 
-def get_embedder() -> Embedder:
-    """Get the embedder."""
-    return OpenAIEmbedder()
+@functools.lru_cache(maxsize=None)
+def get_embedding_cache() -> EmbeddingCache:
+    """Get the on-disk embedding cache shared by the process."""
+    os.makedirs(LIBRARIAN_DIR, exist_ok=True)
+    db_path = os.path.join(LIBRARIAN_DIR, "embedding_cache.db")
+    return EmbeddingCache(db_path, EMBEDDING_CACHE_MAX_ENTRIES)
+
+
+def get_embedder(book_dir: str = None) -> Embedder:
+    """Get the embedder configured by EMBEDDER for the book in book_dir."""
+    if EMBEDDER == "openai":
+        return get_openai_embedder()
+    if EMBEDDER == "local":
+        return LocalEmbedder(book_dir)
+    raise ValueError(f"Unknown embedder {EMBEDDER}.")
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai_embedder() -> Embedder:
+    """Get the OpenAI embedder shared by the process."""
+    # the OpenAI embedder looks up the on-disk cache by itself
+    return CachedEmbedder(
+        OpenAIEmbedder(cache=get_embedding_cache()),
+        max_entries=QUERY_CACHE_MAX_ENTRIES,
+    )
+
+
+def read_index_embedder(book_dir: str) -> str:
+    """Get the name of the embedder a book was indexed with."""
+    try:
+        with open(os.path.join(book_dir, EMBEDDER_FILE)) as f:
+            return json.load(f)["name"]
+    except FileNotFoundError:
+        return LEGACY_EMBEDDER
+
+
+def write_index_embedder(book_dir: str, embedder: Embedder) -> None:
+    """Record the embedder a book is indexed with."""
+    with open(os.path.join(book_dir, EMBEDDER_FILE), "w") as f:
+        json.dump({"name": embedder.name}, f)
+
+
+def check_index_embedder(book_dir: str, embedder: Embedder) -> None:
+    """Refuse to query a book with another embedder than its index's."""
+    indexed = read_index_embedder(book_dir)
+    if indexed != embedder.name:
+        raise ValueError(
+            f"The book was indexed with the {indexed} embedder but "
+            f"{embedder.name} is configured, rebuild it to switch."
+        )
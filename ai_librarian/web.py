@@ -1,14 +1,78 @@
 import os
+import json
 import tempfile
+import threading
+import uuid
 from openai.error import AuthenticationError
 
-from flask import Flask, request, jsonify, make_response
-
+from flask import (
+    Flask,
+    Response,
+    g,
+    request,
+    jsonify,
+    make_response,
+    stream_with_context,
+)
+
+from . import metrics
 from .librarian import Librarian
 from .book_keeper import BookKeeper
+from .const import (
+    ASK_BATCH_MAX_SIZE,
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_PAGE_SIZE,
+    LIBRARIAN_POOL_PRELOAD,
+)
 
 app = Flask(__name__, static_folder="../web/dist/")
 
+BookKeeper.instance().resume_jobs()
+
+if LIBRARIAN_POOL_PRELOAD > 0:
+    threading.Thread(
+        target=BookKeeper.instance().preload_librarians,
+        args=(LIBRARIAN_POOL_PRELOAD,),
+        daemon=True,
+    ).start()
+
+
+@app.before_request
+def start_trace():
+    # a request id given by a proxy ties our logs to its own
+    request_id = request.headers.get("X-Request-Id") or uuid.uuid4().hex
+    g.trace = metrics.start_trace(request_id)
+
+
+@app.after_request
+def add_request_id(response):
+    response.headers["X-Request-Id"] = g.trace.request_id
+    g.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def end_trace(exc):
+    trace = g.get("trace")
+    if trace is None:
+        return
+
+    metrics.end_trace(trace)
+    # streamed responses are torn down again once the stream has ended
+    if g.get("streaming") and not g.get("stream_done"):
+        return
+
+    g.pop("trace")
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    status = str(g.get("status", 500))
+    metrics.REQUEST_SECONDS.observe(
+        trace.elapsed(), request.method, route, status
+    )
+    if route.startswith("/api/") and route != "/api/metrics":
+        metrics.log_trace(
+            trace, f"{request.method} {request.path} {status}"
+        )
+
 
 @app.route("/")
 def index():
@@ -33,16 +97,17 @@ def upload_book():
         raise ValueError("book is empty")
 
     ext_name = os.path.splitext(request.files["book"].filename)[1]
-    with tempfile.NamedTemporaryFile(suffix=ext_name) as f:
-        print(f.name)
-        request.files["book"].save(f.name)
-        book_id = BookKeeper.instance().add_book(name, f.name)
+    fd, path = tempfile.mkstemp(suffix=ext_name)
+    os.close(fd)
+    try:
+        request.files["book"].save(path)
+        # the book keeper takes over the file
+        job = BookKeeper.instance().submit_book(name, path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
 
-    resp = {
-        "book_id": book_id,
-        "name": name,
-    }
-    return jsonify(resp)
+    return jsonify(job_to_json(job))
 
 
 @app.route("/api/books/<book_id>", methods=["DELETE"])
@@ -58,12 +123,93 @@ def ask(book_id):
         raise ValueError("q is required")
 
     librarian = BookKeeper.instance().get_librarian(book_id)
+
+    accept = request.headers.get("Accept", "")
+    if request.args.get("stream") or "text/event-stream" in accept:
+        g.streaming = True
+        events = stream_answer(librarian, question)
+        return Response(
+            stream_with_context(events), mimetype="text/event-stream"
+        )
+
     return librarian.ask_question_logged(question)
 
 
+@app.route("/api/books/<book_id>/ask_batch", methods=["POST"])
+def ask_batch(book_id):
+    body = request.get_json(silent=True) or {}
+    questions = body.get("questions")
+    if not isinstance(questions, list) or not questions:
+        raise ValueError("questions is required")
+    if not all(isinstance(q, str) and q for q in questions):
+        raise ValueError("questions must be non-empty strings")
+    if len(questions) > ASK_BATCH_MAX_SIZE:
+        raise ValueError(
+            f"at most {ASK_BATCH_MAX_SIZE} questions can be asked at once"
+        )
+
+    librarian = BookKeeper.instance().get_librarian(book_id)
+    return jsonify(librarian.ask_many(questions))
+
+
+def stream_answer(librarian, question):
+    """Stream the answer to a question as server-sent events.
+
+    Emits a "references" event, then "token" events with pieces of the
+    answer, and finally a "done" event with the logged answer. Failures
+    after the stream started are reported as an "error" event."""
+    metrics.activate_trace(g.trace)
+    try:
+        for event in librarian.ask_question_stream_logged(question):
+            data = {k: v for k, v in event.items() if k != "type"}
+            yield f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
+    except Exception as e:
+        error = {"type": e.__class__.__name__, "message": str(e)}
+        yield f"event: error\ndata: {json.dumps({'error': error})}\n\n"
+    finally:
+        g.stream_done = True
+
+
+@app.route("/api/books/<book_id>/search", methods=["GET"])
+def search(book_id):
+    query = request.args.get("q")
+    if not query:
+        raise ValueError("q is required")
+
+    librarian = BookKeeper.instance().get_librarian(book_id)
+    return jsonify(
+        librarian.search(query, request.args.get("k", 10, type=int))
+    )
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = BookKeeper.instance().get_job(job_id)
+    return jsonify(job_to_json(job))
+
+
+def job_to_json(job):
+    # the server-side path of the book file is of no use to clients
+    return {k: v for k, v in job.items() if k != "file_path"}
+
+
+@app.route("/api/books/<book_id>/answer_cache", methods=["GET"])
+def answer_cache_stats(book_id):
+    return jsonify(BookKeeper.instance().answer_cache.stats(book_id))
+
+
 @app.route("/api/books/<book_id>/history", methods=["GET"])
 def history(book_id):
-    return BookKeeper.instance().list_chat_logs(book_id)
+    limit = request.args.get("limit", HISTORY_PAGE_SIZE, type=int)
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+
+    return BookKeeper.instance().list_chat_logs(
+        book_id,
+        limit=min(limit, HISTORY_MAX_PAGE_SIZE),
+        before=request.args.get("before"),
+        since=request.args.get("since"),
+    )
 
 
 @app.route("/api/books/<book_id>/history/<log_id>", methods=["DELETE"])
@@ -72,6 +218,11 @@ def remove_history(book_id, log_id):
     return "OK"
 
 
+@app.route("/api/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/<path:static_file>")
 def serve_static_file(static_file):
     return app.send_static_file(static_file)
@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import openai
+import pytest
+
+from ai_librarian import embedder
+from ai_librarian.embedder import MAX_RETRIES, OpenAIEmbedder
+
+
+class StandIn:
+    """A local stand-in for the embedding API.
+
+    Each text embeds as [int(text), 1.0], so the order of the results
+    shows which text they belong to. respond(inputs, n) gets the inputs
+    and the number of the request and returns (status, headers, body),
+    or None to answer with the embeddings."""
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        self.respond = lambda inputs, n: None
+
+    def handle(self, body):
+        inputs = json.loads(body)["input"]
+        with self.lock:
+            n = len(self.requests)
+            self.requests.append(inputs)
+
+        response = self.respond(inputs, n)
+        if response is not None:
+            return response
+
+        data = [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": [float(text), 1.0],
+            }
+            for i, text in enumerate(inputs)
+        ]
+        body = {
+            "object": "list",
+            "data": data,
+            "model": "text-embedding-ada-002",
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+        return 200, {}, body
+
+
+def error(status, message, headers=None):
+    body = {"error": {"message": message, "type": "server_error"}}
+    return status, headers or {}, body
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    stand_in = StandIn()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            status, headers, body = stand_in.handle(
+                self.rfile.read(length)
+            )
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(
+        openai, "api_base", f"http://127.0.0.1:{server.server_port}/v1"
+    )
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(openai, "api_type", "open_ai")
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    # one token per character, without tiktoken
+    monkeypatch.setattr(
+        OpenAIEmbedder, "count_tokens", lambda self, text: len(text)
+    )
+
+    yield stand_in
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(embedder.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def texts(n):
+    return [str(i) for i in range(n)]
+
+
+def values(embeddings):
+    return [int(e[0]) for e in embeddings]
+
+
+def test_chunks_bounded_by_size(stand_in, monkeypatch):
+    monkeypatch.setattr(embedder, "CHUNK_SIZE", 3)
+
+    result = OpenAIEmbedder(concurrency=1).embed_texts(texts(7))
+
+    assert stand_in.requests == [["0", "1", "2"], ["3", "4", "5"], ["6"]]
+    assert values(result) == list(range(7))
+
+
+def test_chunks_bounded_by_tokens(stand_in, monkeypatch):
+    monkeypatch.setattr(embedder, "CHUNK_TOKENS", 4)
+    batch = ["1", "22", "3", "44", "5555", "6"]
+
+    result = OpenAIEmbedder(concurrency=1).embed_texts(batch)
+
+    assert stand_in.requests == [["1", "22", "3"], ["44"], ["5555"], ["6"]]
+    assert values(result) == [1, 22, 3, 44, 5555, 6]
+
+
+def test_order_kept_across_concurrent_chunks(stand_in, monkeypatch):
+    monkeypatch.setattr(embedder, "CHUNK_SIZE", 2)
+    finished = []
+
+    # the earlier a chunk, the later its response
+    def respond(inputs, n):
+        time.sleep(0.05 * (5 - int(inputs[0]) // 2))
+        finished.append(inputs)
+
+    stand_in.respond = respond
+
+    batch = texts(10)
+    result = OpenAIEmbedder(concurrency=5).embed_texts(batch + batch)
+
+    assert len(stand_in.requests) == 5
+    assert finished[0] != ["0", "1"]
+    assert values(result) == list(range(10)) * 2
+    assert all(e.dtype == np.float32 for e in result)
+
+
+def test_retry_after_honoured(stand_in, sleeps):
+    def respond(inputs, n):
+        if n == 0:
+            return error(429, "slow down", {"Retry-After": "7"})
+
+    stand_in.respond = respond
+
+    result = OpenAIEmbedder().embed_texts(texts(3))
+
+    assert len(stand_in.requests) == 2
+    # the backoff of the first retry is at most a second
+    assert sleeps == [7.0]
+    assert values(result) == [0, 1, 2]
+
+
+def test_fails_after_max_retries(stand_in, sleeps):
+    stand_in.respond = lambda inputs, n: error(503, "unavailable")
+
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        OpenAIEmbedder().embed_texts(texts(3))
+
+    assert len(stand_in.requests) == MAX_RETRIES + 1
+    assert len(sleeps) == MAX_RETRIES
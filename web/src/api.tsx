@@ -28,8 +28,20 @@ export async function uploadBook({
 
   await handleErrorResp(resp);
 
-  const json = await resp.json();
-  return { id: json.book_id, title: json.name } as Book;
+  // the book is indexed in the background, wait for the job to finish
+  let job = await resp.json();
+  while (job.status === "queued" || job.status === "running") {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    const jobResp = await fetch(`/api/jobs/${job.job_id}`);
+    await handleErrorResp(jobResp);
+    job = await jobResp.json();
+  }
+
+  if (job.status === "failed") {
+    throw new Error(job.error || "Failed to index the book");
+  }
+
+  return { id: job.book_id, title: job.name } as Book;
 }
 
 export async function deleteBook(bookId: BookId): Promise<void> {
@@ -42,12 +54,22 @@ export async function deleteBook(bookId: BookId): Promise<void> {
   await handleErrorResp(resp);
 }
 
-export async function listHistory(bookId: BookId): Promise<HistoryEntry[]> {
+// entries listed by one history request, older ones are loaded on demand
+export const HISTORY_PAGE_SIZE = 100;
+
+export async function listHistory(
+  bookId: BookId,
+  before?: HistoryEntryId
+): Promise<HistoryEntry[]> {
   if (bookId === null || bookId === undefined) {
     return [];
   }
 
-  const resp = await fetch(`/api/books/${bookId}/history`);
+  let query = `?limit=${HISTORY_PAGE_SIZE}`;
+  if (before) {
+    query += `&before=${encodeURIComponent(before)}`;
+  }
+  const resp = await fetch(`/api/books/${bookId}/history${query}`);
   await handleErrorResp(resp);
 
   const json = await resp.json();
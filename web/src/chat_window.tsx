@@ -1,6 +1,6 @@
-import React, { useReducer, useEffect } from "react";
+import React, { useReducer, useEffect, useState } from "react";
 
-import { listHistory } from "./api";
+import { listHistory, HISTORY_PAGE_SIZE } from "./api";
 import { HistoryBacklog } from "./history";
 
 import * as t from "./types";
@@ -11,6 +11,9 @@ function historyReducer(history: t.History, action: t.HistoryAction) {
     return [action.entry, ...history];
   } else if (action.type == "init") {
     return action.history;
+  } else if (action.type == "more") {
+    // older entries go after the ones already listed, newest first
+    return [...history, ...action.history];
   } else if (action.type == "delete") {
     return history.filter((entry) => entry.id !== action.id);
   } else {
@@ -23,13 +26,23 @@ interface ChatWindowProps {
 }
 export function ChatWindow({ bookId }: ChatWindowProps) {
   const [history, dispatchHistory] = useReducer(historyReducer, null);
+  const [hasMore, setHasMore] = useState(false);
 
   useEffect(() => {
-    listHistory(bookId).then((history) =>
-      dispatchHistory({ type: "init", history })
-    );
+    listHistory(bookId).then((history) => {
+      dispatchHistory({ type: "init", history });
+      setHasMore(history.length === HISTORY_PAGE_SIZE);
+    });
   }, [bookId]);
 
+  function loadMore() {
+    const oldest = history[history.length - 1];
+    listHistory(bookId, oldest.id).then((older) => {
+      dispatchHistory({ type: "more", history: older });
+      setHasMore(older.length === HISTORY_PAGE_SIZE);
+    });
+  }
+
   if (!bookId)
     return <div className="chat-window unavailable">Select a book.</div>;
 
@@ -42,6 +55,7 @@ export function ChatWindow({ bookId }: ChatWindowProps) {
         bookId={bookId}
         history={history}
         dispatchHistory={dispatchHistory}
+        onLoadMore={hasMore && history.length > 0 ? loadMore : null}
       />
       <AskBar
         bookId={bookId}
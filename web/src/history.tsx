@@ -133,12 +133,15 @@ interface HistoryBacklogProps {
   bookId: t.BookId;
   history: t.History;
   dispatchHistory: (action: t.HistoryAction) => void;
+  // loads older entries, null once there are none left
+  onLoadMore: (() => void) | null;
 }
 
 export function HistoryBacklog({
   history,
   dispatchHistory,
   bookId,
+  onLoadMore,
 }: HistoryBacklogProps) {
   return (
     <div className="history-backlog">
@@ -150,6 +153,12 @@ export function HistoryBacklog({
           dispatchHistory={dispatchHistory}
         />
       ))}
+      {/* the backlog is reversed, so this shows above the oldest entry */}
+      {onLoadMore && (
+        <div className="load-more" onClick={onLoadMore}>
+          Load older questions
+        </div>
+      )}
     </div>
   );
 }
@@ -14,6 +14,9 @@ export interface Reference {
     next_id?: RefId;
     prev_id?: RefId;
     merged_ids?: RefId[];
+    parent_id?: RefId;
+    start?: number;
+    end?: number;
   };
 }
 
@@ -46,4 +49,5 @@ export type History = HistoryEntry[];
 export type HistoryAction =
   | { type: "add"; entry: HistoryEntry }
   | { type: "init"; history: History }
+  | { type: "more"; history: History }
   | { type: "delete"; id: HistoryEntryId };